@@ -0,0 +1 @@
+""" Throughput benchmarks of ingest parsers and cumulative report rendering, run with python -m benchmarks.run """
@@ -0,0 +1,191 @@
+""" Synthetic machine exports and report data shaped like real Sciex, Olympus AU400 and FilmArray output """
+import random
+import re
+
+
+SCIEX_HEADER = ('Sample Name', 'Component Name', 'Actual Concentration', 'Calculated Concentration')
+SCIEX_COMPONENTS = ('Amphetamine', 'Methamphetamine', 'MDMA', 'Morphine', 'Codeine', 'Oxycodone', 'Fentanyl',
+                    'Norfentanyl', 'Buprenorphine', 'Benzoylecgonine', 'Alprazolam', 'THC-COOH')
+
+# Column order of result_machine_olympus, cut offs as in helper_methods
+OLYMPUS_TESTS = (('amphetamine', 1000), ('barbiturates', 200), ('benzodiazepine', 200), ('cocaine', 150),
+                 ('methadone', 300), ('opiates', 300), ('oxycodone', 100), ('phencyclidine_pcp', 25),
+                 ('thc_cooh', 50), ('ecstacy_mdma', 500))
+OLYMPUS_SPECIMEN_TYPES = 'USB'
+
+# database_helper.REPR_NUMBERS, numbers report writes out from typed column
+REPR_NUMBER = re.compile(r'-?(?:0|[1-9][0-9]{0,7})[.](?:[0-9]{0,6}[1-9]|0)')
+
+FIRST_NAMES = ('JOHN', 'MARY', 'PETER', 'ANNA', 'JAMES', 'LINDA', 'OMAR', 'SARA', 'BAT-ERDENE', 'TUVSHIN')
+LAST_NAMES = ('DOE', 'SMITH', 'JOHNSON', "O'NEIL", 'GARCIA', 'LEE', 'BROWN', 'DAVIS', 'BOLD', 'MILLER')
+
+FILM_ARRAY_GROUPS = (('RP', 'Respiratory Panel', ('Adenovirus', 'Coronavirus 229E', 'Coronavirus HKU1', 'Coronavirus NL63',
+                                                  'Coronavirus OC43', 'SARS-CoV-2', 'Human Metapneumovirus',
+                                                  'Influenza A', 'Influenza B', 'Parainfluenza 1', 'RSV')),
+                     ('BAC', 'Bacteria', ('Bordetella parapertussis', 'Bordetella pertussis', 'Chlamydia pneumoniae',
+                                          'Mycoplasma pneumoniae')))
+
+
+def raw_text(text):
+    """ Raw column value of number as ingest stores it, None where report writes number out as sent """
+    return None if REPR_NUMBER.fullmatch(text) else text
+
+
+def accession_number(rng, index):
+    return 210210000 + index * 7 + rng.randrange(7)
+
+
+def write_sciex(path, rows, file_type='txt', seed=0):
+    """ Writes Sciex results export, about 1% of rows miss concentration columns
+        Args: path, rows(number of result rows), file_type(txt or csv), seed
+        Returns: number of rows written
+    """
+    rng = random.Random(seed)
+    separator = '\t' if file_type == 'txt' else ','
+
+    with open(path, 'w') as export:
+        export.write(separator.join(SCIEX_HEADER) + '\n')
+
+        for index in range(rows):
+            fields = [str(accession_number(rng, index // len(SCIEX_COMPONENTS))), SCIEX_COMPONENTS[index % len(SCIEX_COMPONENTS)]]
+            if rng.random() >= 0.01:
+                fields.append('{:.2f}'.format(rng.uniform(0, 1000)))
+                fields.append('N/A' if rng.random() < 0.1 else '{:.4f}'.format(rng.uniform(0, 1000)))
+
+            export.write(separator.join(fields) + '\n')
+
+    return rows
+
+
+def olympus_line(rng, index):
+    """ One AU400 record: accession number with specimen type, patient name, '01' and value/flag pair per test """
+    name = '{}, {}'.format(rng.choice(LAST_NAMES), rng.choice(FIRST_NAMES))
+    values = ' '.join('{:.1f} {}'.format(rng.uniform(0, cut_off * 2), position)
+                      for position, (test, cut_off) in enumerate(OLYMPUS_TESTS, 1))
+
+    return '{}{} {} 01 {}\n'.format(accession_number(rng, index), rng.choice(OLYMPUS_SPECIMEN_TYPES), name, values)
+
+
+def write_olympus(path, rows, seed=0):
+    """ Writes Olympus AU400 LOG export
+        Args: path, rows(number of records), seed
+        Returns: number of rows written
+    """
+    rng = random.Random(seed)
+
+    with open(path, 'w') as export:
+        for index in range(rows):
+            export.write(olympus_line(rng, index))
+
+    return rows
+
+
+def film_array_test_order(rng, index):
+    groups = []
+    for code, name, tests in FILM_ARRAY_GROUPS:
+        results = []
+        for position, test_name in enumerate(tests):
+            detected = rng.random() < 0.05
+            results.append("""
+          <result>
+            <resultID><resultTestCode>{code}-{position}</resultTestCode><resultTestName>{test_name}</resultTestName><resultCodingSystem>BioFire</resultCodingSystem></resultID>
+            <value><testResult><valueType>{value_type}</valueType><observationValue>{value}</observationValue><observationName>{observation}</observationName></testResult></value>
+            <operatorName>lab-operator</operatorName>
+            <resultDateTime>2021-04-06T10:{minute:02d}:00</resultDateTime>
+          </result>""".format(code=code, position=position, test_name=test_name, value_type='Positive' if detected else 'Negative',
+                              value=int(detected), observation='Detected' if detected else 'Not Detected', minute=index % 60))
+
+        groups.append("""
+        <resultGroup>
+          <resultGroupCode>{code}</resultGroupCode><resultGroupName>{name}</resultGroupName><resultGroupCodingSystem>BioFire</resultGroupCodingSystem>{results}
+        </resultGroup>""".format(code=code, name=name, results=''.join(results)))
+
+    return """
+    <testOrder>
+      <specimen><specimenIdentifier>{specimen}</specimenIdentifier></specimen>
+      <test>
+        <universalIdentifier><testIdentifier>RP2.1</testIdentifier><testName>Respiratory Panel 2.1</testName><testVersion>1</testVersion></universalIdentifier>
+        <instrumentType>FilmArray Torch</instrumentType><instrumentSerialNumber>TM{serial:05d}</instrumentSerialNumber>
+        <disposableData><disposable><disposableIdentifier>P{index:08d}</disposableIdentifier><reference>RFIT-ASY-0137</reference><disposableType>Pouch</disposableType><lotNumber>{lot}</lotNumber></disposable></disposableData>{groups}
+      </test>
+    </testOrder>""".format(specimen=accession_number(rng, index), serial=index % 7, index=index, lot=rng.randrange(100000, 999999),
+                           groups=''.join(groups))
+
+
+def write_film_array(path, test_orders, seed=0):
+    """ Writes FilmArray XML export with requestStatus after test orders, as streaming exports come
+        Args: path, test_orders(number of testOrder elements), seed
+        Returns: number of results written
+    """
+    rng = random.Random(seed)
+
+    with open(path, 'w') as export:
+        export.write("""<?xml version="1.0" encoding="UTF-8"?>
+<filmArrayMessage>
+  <header><senderName>FilmArray</senderName><processingIdentifier>P</processingIdentifier><version>1.0</version><dateTime>2021-04-06T10:00:00</dateTime><messageType>result</messageType></header>
+  <requestResult>""")
+        for index in range(test_orders):
+            export.write(film_array_test_order(rng, index))
+        export.write("""
+    <requestStatus>complete</requestStatus>
+  </requestResult>
+</filmArrayMessage>
+""")
+
+    return test_orders * sum(len(tests) for code, name, tests in FILM_ARRAY_GROUPS)
+
+
+def report_data(specs, seed=0):
+    """ Patient rows and spec data of one patient, as fetch_patient_results and fetch_spec_data return them
+        Args: specs(number of accession numbers, machines taken in turn), seed
+        Returns: (patient_results, spec_data)
+    """
+    rng = random.Random(seed)
+    tables = ('result_machine_olympus', 'result_machine_sciex', 'result_machine_film_array')
+
+    patient_results = []
+    spec_data = {table: {} for table in tables}
+    spec_data['max_ids'] = {table: {} for table in tables}
+    group_id = result_id = 0
+
+    for index in range(specs):
+        table = tables[index % len(tables)]
+        number = str(accession_number(rng, index))
+        patient_results.append({'patient_id': 1, 'first_name': 'JOHN', 'last_name': 'DOE', 'gender': 'male', 'created_by': 1,
+                                'accession_number': number, 'results_table': table,
+                                'type': 'nasal swab' if table == 'result_machine_film_array' else 'urine'})
+
+        if table == 'result_machine_olympus':
+            values = ['{:.1f}'.format(rng.uniform(0, cut_off * 2)) for test, cut_off in OLYMPUS_TESTS]
+            olympus = {test: float(value) for (test, cut_off), value in zip(OLYMPUS_TESTS, values)}
+            olympus['raw_values'] = None if all(raw_text(value) is None for value in values) else ' '.join(values)
+            spec_data[table][number] = [olympus]
+            spec_data['max_ids'][table][number] = index
+
+        elif table == 'result_machine_sciex':
+            sciex = []
+            for component in SCIEX_COMPONENTS:
+                actual, calculated = '{:.2f}'.format(rng.uniform(0, 1000)), '{:.4f}'.format(rng.uniform(0, 1000))
+                sciex.append({'component_name': component, 'actual_concentration': float(actual), 'actual_concentration_raw': raw_text(actual),
+                              'calculated_concentration': float(calculated), 'calculated_concentration_raw': raw_text(calculated)})
+            spec_data[table][number] = sciex
+            spec_data['max_ids'][table][number] = index
+
+        else:
+            groups = []
+            for code, name, tests in FILM_ARRAY_GROUPS:
+                group_id += 1
+                results = []
+                for test_name in tests:
+                    result_id += 1
+                    detected = rng.random() < 0.05
+                    results.append({'result_id': result_id, 'result_group_id': group_id, 'result_test_name': test_name,
+                                    'observation_name': 'Detected' if detected else 'Not Detected',
+                                    'value_type': 'Positive' if detected else 'Negative'})
+                groups.append({'result_group': {'result_group_id': group_id, 'result_group_name': name}, 'results': results})
+
+            film_array = {'test_id': index, 'test_name': 'Respiratory Panel 2.1', 'test_identifier': 'RP2.1'}
+            spec_data[table][number] = [(film_array, groups)]
+            spec_data['max_ids'][table][number] = index
+
+    return patient_results, spec_data
@@ -0,0 +1,242 @@
+""" Runs every pipeline on synthetic data and reports throughput, latency percentiles and peak memory
+
+    python -m benchmarks.run                         # in-process fake DB
+    python -m benchmarks.run --mysql HOST USER PASSWORD DB_NAME
+    python -m benchmarks.run --json result.json --baseline baseline.json
+"""
+import argparse
+import contextlib
+import functools
+import gc
+import importlib.util
+import json
+import math
+import os
+import sys
+import tempfile
+import tracemalloc
+import xml.etree.ElementTree as ET
+from time import perf_counter
+
+from benchmarks import generators
+from benchmarks.fake_db import FakeConnection
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_DIRS = ('layers/write-to-db-layer/python/lib/python3.8/site-packages',
+              'layers/cumulative-layer/python/lib/python3.8/site-packages')
+
+SCIEX_SQL = """INSERT INTO result_machine_sciex (sample_name, component_name, actual_concentration, actual_concentration_raw,
+               calculated_concentration, calculated_concentration_raw) VALUES (%s, %s, %s, %s, %s, %s)"""
+OLYMPUS_SQL = """INSERT INTO result_machine_olympus
+                 (accession_number, specimen_type, patient_name, amphetamine,
+                 barbiturates, benzodiazepine, cocaine, methadone,
+                 opiates, oxycodone, phencyclidine_pcp, thc_cooh, ecstacy_mdma, raw_values)
+                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+
+
+def load_handler(name, directory):
+    """ Imports lambda_function.py of function directory under its own module name """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(PROJECT_DIR, directory, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, share):
+    """ Nearest-rank percentile """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+
+def measure(run, repeat):
+    """ Times run repeat times, then once more under tracemalloc for peak memory
+        Args: run(function returning number of rows), repeat
+        Returns: dict of metrics
+    """
+    durations = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            gc.collect()
+            start = perf_counter()
+            rows = run()
+            durations.append(perf_counter() - start)
+
+        # Separate run, tracemalloc slows allocations down
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    median = percentile(durations, 0.5)
+    return {'rows': rows, 'rows_per_sec': rows / median if median else 0, 'p50': median,
+            'p95': percentile(durations, 0.95), 'p99': percentile(durations, 0.99), 'peak_bytes': peak_bytes}
+
+
+def build_cases(args, workdir, connect):
+    """ Generates input files and returns (name, run) of every selected pipeline """
+    db_helper = importlib.import_module('database_helper')
+    cases = []
+
+    def selected(name):
+        return not args.only or any(name.startswith(prefix) for prefix in args.only)
+
+    if selected('sciex'):
+        sciex = load_handler('sciex_lambda', 'sciex-write-mysql')
+        for file_type in ('txt', 'csv'):
+            path = os.path.join(workdir, 'sciex.' + file_type)
+            generators.write_sciex(path, args.rows, file_type)
+
+            def run_sciex(path=path, file_type=file_type, insert_batches=db_helper.insert_batches):
+                conn = connect()
+                return insert_batches(conn, SCIEX_SQL, sciex.get_optimized_query_data(path, file_type))
+
+            cases.append(('sciex-' + file_type, run_sciex))
+            cases.append(('sciex-{}-pipelined'.format(file_type),
+                          functools.partial(run_sciex, insert_batches=db_helper.insert_batches_pipelined)))
+
+    if selected('olympus'):
+        olympus = load_handler('olympus_lambda', 'olympus')
+        olympus_path = os.path.join(workdir, 'olympus.log')
+        generators.write_olympus(olympus_path, args.rows)
+
+        def run_olympus(insert_batches=db_helper.insert_batches):
+            conn = connect()
+            return insert_batches(conn, OLYMPUS_SQL, olympus.get_optimized_query_data(olympus_path))
+
+        cases.append(('olympus-log', run_olympus))
+        cases.append(('olympus-log-pipelined', functools.partial(run_olympus, insert_batches=db_helper.insert_batches_pipelined)))
+
+    if selected('film-array'):
+        film_array = load_handler('film_array_lambda', 'film-array-xml')
+        xml_path = os.path.join(workdir, 'film_array.xml')
+        generators.write_film_array(xml_path, args.test_orders)
+
+        # Every export of parsed mode carries one test, as instruments upload them
+        single_path = os.path.join(workdir, 'film_array_single.xml')
+        generators.write_film_array(single_path, 1)
+
+        def run_film_array_streaming():
+            conn = connect()
+            with open(xml_path, 'rb') as source:
+                rows = film_array.write_streaming_xml(source, conn)
+            conn.commit()
+            return rows
+
+        def run_film_array_parsed():
+            conn = connect()
+            rows = 0
+            for _ in range(args.test_orders):
+                rows += film_array.write_parsed_xml(ET.parse(single_path).getroot(), conn)
+                conn.commit()
+            return rows
+
+        cases.append(('film-array-streaming', run_film_array_streaming))
+        cases.append(('film-array-parsed', run_film_array_parsed))
+
+    if selected('build-spec') or selected('render-pdf'):
+        report = load_handler('cumulative_lambda', 'cumulative-report')
+        patient_results, spec_data = generators.report_data(args.specs)
+
+        def run_build_spec():
+            # Cold cache, so every spec is rendered
+            report.spec_cache.entries.clear()
+            for result in patient_results:
+                report.build_spec(spec_data, result['results_table'], result['accession_number'], '04/06/2021 at 10:00',
+                                  result['type'], s_request_time='04/06/2021')
+            return len(patient_results)
+
+        def run_render_pdf():
+            html_shards, footer = report.build_report_html(patient_results, '1', spec_data, '04/06/2021 at 10:00')
+            timings, pdf, error = report.render_pdf(('benchmark.pdf', html_shards, footer, report.REPORT_WORKERS))
+            if error:
+                raise RuntimeError(error)
+            return len(patient_results)
+
+        def run_build_spec_warm():
+            # Every spec but those of first run is served by spec cache
+            for result in patient_results:
+                report.build_spec(spec_data, result['results_table'], result['accession_number'], '04/06/2021 at 10:00',
+                                  result['type'], s_request_time='04/06/2021')
+            return len(patient_results)
+
+        if selected('build-spec'):
+            cases.append(('build-spec', run_build_spec))
+            cases.append(('build-spec-warm', run_build_spec_warm))
+        if selected('render-pdf'):
+            cases.append(('render-pdf', run_render_pdf))
+
+    return cases
+
+
+def compare(results, baseline, tolerance):
+    """ Returns names of cases whose throughput dropped below baseline by more than tolerance """
+    regressions = []
+    for name, metrics in results.items():
+        expected = baseline.get(name, {}).get('rows_per_sec')
+        if expected and metrics['rows_per_sec'] < expected * (1 - tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000, help='rows of Sciex and Olympus exports')
+    parser.add_argument('--test-orders', type=int, default=200, help='testOrder elements of FilmArray export')
+    parser.add_argument('--specs', type=int, default=60, help='accession numbers of cumulative report')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='*', help='case name prefixes, e.g. sciex olympus')
+    parser.add_argument('--mysql', nargs=4, metavar=('HOST', 'USER', 'PASSWORD', 'DB_NAME'),
+                        help='local MySQL stand-in instead of in-process fake, tables are migrated first')
+    parser.add_argument('--db-latency', type=float, default=0, help='seconds every fake DB statement and commit waits')
+    parser.add_argument('--json', help='writes results to this file')
+    parser.add_argument('--baseline', help='results file of earlier run, exits with 1 on throughput regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed throughput drop against baseline')
+    args = parser.parse_args(argv)
+
+    for layer_dir in LAYER_DIRS:
+        sys.path.insert(0, os.path.join(PROJECT_DIR, layer_dir))
+    for name in ('DB_HOST', 'DB_USERNAME', 'DB_PASSWORD', 'DB_NAME', 'BUCKET_NAME', 'LAB_NAME'):
+        os.environ.setdefault(name, 'benchmark')
+
+    if args.mysql:
+        db_helper = importlib.import_module('database_helper')
+        host, user, password, db_name = args.mysql
+        # Applies table-copy migrations too, as admin invocation does
+        db_helper.migrate(db_helper.get_connection(host, user, password, db_name), db_name, offline=True)
+
+        def connect():
+            return db_helper.get_connection(host, user, password, db_name)
+    else:
+        connect = functools.partial(FakeConnection, latency=args.db_latency)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        print('{:<22}{:>10}{:>14}{:>10}{:>10}{:>10}{:>12}'.format('case', 'rows', 'rows/sec', 'p50 s', 'p95 s', 'p99 s', 'peak MiB'))
+
+        for name, run in build_cases(args, workdir, connect):
+            metrics = results[name] = measure(run, args.repeat)
+            print('{:<22}{:>10}{:>14.0f}{:>10.3f}{:>10.3f}{:>10.3f}{:>12.1f}'.format(
+                name, metrics['rows'], metrics['rows_per_sec'], metrics['p50'], metrics['p95'], metrics['p99'],
+                metrics['peak_bytes'] / 1024 / 1024))
+
+    if args.json:
+        with open(args.json, 'w') as result_file:
+            json.dump(results, result_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+
+        if regressions:
+            print('FAIL: Throughput regressed more than {:.0%}: {}'.format(args.tolerance, ', '.join(regressions)))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,46 +1,191 @@
 import sys
 import os
-import tempfile
-from time import strftime, gmtime, time
-
-import boto3
-import pymysql
-from xhtml2pdf import pisa
-
+import io
+from concurrent.futures import ThreadPoolExecutor
+from time import strftime, gmtime, time, perf_counter
+
+import cold_start
+import database_helper as db_helper
+import metrics
+import process_pool
+from spec_cache import SpecCache, REPORTED_TIME_TOKEN
 from helper_methods import __get_olympus_spec, __get_sciex_spec, __get_film_array_spec, \
-                    source_html, css_style, __get_header, __get_title_date, __get_patient_info, __get_footer
+                    source_html_template, css_style, __get_header, __get_title_date, __get_patient_info, __get_footer
                     
 
 DB_HOST = os.environ['DB_HOST']
 DB_USERNAME = os.environ['DB_USERNAME']
 DB_PASSWORD = os.environ['DB_PASSWORD']
 DB_NAME = os.environ['DB_NAME']
-PATIENT_ID = os.environ['PATIENT_ID']
+
+# Patient and machine result queries go to reader endpoint while it is at most DB_READER_MAX_LAG seconds behind,
+# report_cumulative rows are always written on DB_HOST
+DB_READER_HOST = os.environ.get('DB_READER_HOST')
+DB_READER_MAX_LAG = float(os.environ.get('DB_READER_MAX_LAG', 30))
+
+PATIENT_ID = os.environ.get('PATIENT_ID')
 BUCKET_NAME = os.environ['BUCKET_NAME']
 LAB_NAME = os.environ['LAB_NAME']
 
-s3 = boto3.client('s3')
+# PDFs over one part are uploaded in parallel multipart chunks
+UPLOAD_PART_SIZE = int(os.environ.get('UPLOAD_PART_SIZE', 8 * 1024 * 1024))
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+
+# Batch mode renders reports across this many processes
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', 0)) or process_pool.available_cpus()
+
+# Reports with more spec sections than this are rendered in shards of this size, 0 renders every report whole
+PDF_SHARD_SPECS = int(os.environ.get('PDF_SHARD_SPECS', 0))
 
+# Rendered specs are reused by warm container while fetched rows stay the same
+spec_cache = SpecCache(max_entries=int(os.environ.get('SPEC_CACHE_SIZE', 2048)))
 
+
+@cold_start.report_init
+@metrics.instrumented('cumulative-report')
 def lambda_handler(event, context):
     gmt_time = gmtime()
     date_time_reported = strftime('%m/%d/%Y at %H:%M', gmt_time)
     
-    # Connection setup
+    # Connection setup, reused while the container stays warm
     try:
-        conn = pymysql.connect(host=DB_HOST, user=DB_USERNAME,
-                               passwd=DB_PASSWORD, db=DB_NAME,
-                               connect_timeout=5, charset='utf8mb4',
-                               cursorclass=pymysql.cursors.DictCursor)
+        with metrics.span('connect'):
+            conn = db_helper.get_connection(DB_HOST, DB_USERNAME, DB_PASSWORD, DB_NAME)
+
+            read_conn = None
+            if DB_READER_HOST:
+                read_conn = db_helper.get_reader_connection(DB_READER_HOST, DB_USERNAME, DB_PASSWORD, DB_NAME, DB_READER_MAX_LAG)
+            metrics.set_property('read_from', 'reader' if read_conn else 'writer')
+            read_conn = read_conn or conn
 
-    except pymysql.MySQLError as e:
+    except db_helper.MySQLError as e:
         print("FAIL: Unexpected error: Could not connect to MySQL instance.")
         print(e)
         sys.exit()
 
-    print("SUCCESS: Connection to RDS MySQL instance succeeded")
-    
-    # Get list of results for given patient
+    # Batch mode takes list of patient ids from event, otherwise single report for PATIENT_ID
+    patient_ids = [str(patient_id) for patient_id in (event or {}).get('patient_ids', [])]
+    batch_mode = len(patient_ids) > 0
+    if not batch_mode:
+        patient_ids = [PATIENT_ID]
+
+    metrics.count('patients', len(patient_ids))
+
+    # Get list of results for every patient with shared queries
+    with metrics.span('fetch_patients'):
+        patients_results = fetch_patient_results(read_conn, patient_ids)
+
+    if not batch_mode and PATIENT_ID not in patients_results:
+        raise ValueError('FAIL: No patient with given PATIENT_ID is found.!')
+
+    # Fetching machine results of every accession number at once
+    with metrics.span('fetch_specs'):
+        spec_data = fetch_spec_data(read_conn, [result for patient_results in patients_results.values() for result in patient_results])
+
+    # Ends read snapshot, so replica does not keep it open until next invocation
+    if read_conn is not conn:
+        read_conn.rollback()
+
+    reports = []
+    jobs = []
+    for patient_id in patient_ids:
+        report = {'patient_id': patient_id, 'status': 'FAIL', 'timings': {}}
+        reports.append(report)
+
+        if patient_id not in patients_results:
+            report['error'] = 'No patient with given patient id is found.'
+            print('FAIL: No patient with given patient id is found.! {}'.format(patient_id))
+            continue
+
+        start = perf_counter()
+        try:
+            html_shards, footer = build_report_html(patients_results[patient_id], patient_id, spec_data, date_time_reported)
+        except ValueError as e:
+            if not batch_mode:
+                raise
+            report['error'] = str(e)
+            print(e)
+            continue
+
+        report['timings']['build_html'] = perf_counter() - start
+        metrics.add_duration('build_html', report['timings']['build_html'])
+
+        # Building file name
+        random_seconds = str(time()).split('.')[1]
+        datetime_iso_combined = strftime('%Y%m%d-%H%M%S', gmt_time)
+        report['file_name'] = '{patient_id}_{timestamp}_{seconds}.pdf'.format(patient_id=patient_id, timestamp=datetime_iso_combined, seconds=random_seconds)
+
+        jobs.append((report, html_shards, footer))
+
+    # Processes left over from reports render shards of sharded reports
+    shard_workers = REPORT_WORKERS // max(1, min(REPORT_WORKERS, len(jobs)))
+
+    # Imported before workers are forked, so they share it instead of importing it each
+    if jobs:
+        cold_start.load_module('xhtml2pdf.pisa')
+
+    # PDFs are rendered in memory in parallel, one process per vCPU
+    rendered = process_pool.map_in_processes(render_pdf, [(report['file_name'], html_shards, footer, shard_workers)
+                                                          for report, html_shards, footer in jobs], REPORT_WORKERS)
+
+    # Insert into report_cumulative
+    date_report_time_table = strftime('%Y-%m-%d-%H-%M', gmt_time)
+    report_data = []
+
+    # Uploads run while rows are inserted, rows of failed uploads are deleted before commit
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        uploads = []
+        for (report, html_shards, footer), (timings, pdf, error) in zip(jobs, rendered):
+            report['timings'].update(timings)
+            for stage, seconds in timings.items():
+                metrics.add_duration(stage, seconds)
+
+            if error:
+                report['error'] = error
+                print('FAIL: Report is not generated! {} {}'.format(report['patient_id'], error))
+                continue
+
+            uploads.append((report, executor.submit(upload_pdf, pdf, report['file_name'])))
+            metrics.count('pdf_bytes', len(pdf))
+
+            created_by = patients_results[report['patient_id']][0]['created_by']
+            report_data.append((report['patient_id'], created_by, date_report_time_table, report['file_name']))
+
+        with conn.cursor() as cursor:
+            sql = """INSERT INTO report_cumulative (patient_id, created_by, created_at, filepath) 
+                      values (%s, %s, %s, %s);"""
+            with metrics.span('insert'):
+                cursor.executemany(sql, report_data)
+
+            failed_files = []
+            with metrics.span('upload_wait'):
+                for report, upload in uploads:
+                    try:
+                        report['timings']['upload'] = upload.result()
+                        report['status'] = 'SUCCESS'
+                        metrics.count('reports')
+                    except Exception as e:
+                        report['error'] = '{}: {}'.format(type(e).__name__, e)
+                        failed_files.append(report['file_name'])
+                        print('FAIL: Report is not uploaded! {} {}'.format(report['patient_id'], report['error']))
+
+            if failed_files:
+                cursor.executemany("delete from report_cumulative where filepath = %s;", failed_files)
+
+            with metrics.span('commit'):
+                conn.commit()
+
+    if not batch_mode and reports[0]['status'] != 'SUCCESS':
+        raise RuntimeError('FAIL: Report is not generated! {}'.format(reports[0].get('error')))
+
+    return {'reports': reports}
+
+
+def fetch_patient_results(conn, patient_ids):
+    """ Fetches results of every patient with one query
+        Args: conn(DB connection), patient_ids
+        Returns: dict of patient id -> rows
+    """
     with conn.cursor() as cursor:
         sql = """
             select * from patient p
@@ -48,157 +193,268 @@ def lambda_handler(event, context):
             left join specimen s on s.accession_number = r.accession_number
             left join specimen_result sr on sr.specimen_id = s.specimen_id
             left join medical_machine m on sr.machine_id = m.machine_id
-            where p.patient_id = %s;
-        """
-        cursor.execute(sql, (PATIENT_ID, ))
-        patient_results = cursor.fetchall()
-        
-        if len(patient_results) == 0:
-            raise ValueError('FAIL: No patient with given PATIENT_ID is found.!')
-            print('FAIL: No patient with given PATIENT_ID is found.!')
+            where p.patient_id in ({});
+        """.format(', '.join(['%s'] * len(patient_ids)))
+        cursor.execute(sql, patient_ids)
 
+        patients_results = {}
+        for result in cursor.fetchall():
+            patients_results.setdefault(str(result['patient_id']), []).append(result)
 
+    return patients_results
+
+
+def build_report_html(patient_results, patient_id, spec_data, date_time_reported):
+    """ Builds report HTML of one patient
+        Args: patient_results(rows of patient), patient_id, spec_data(from fetch_spec_data), date_time_reported
+        Returns: (list of HTML shards, footer), single shard is whole report with footer
+    """
     # Building results specs
-    specs = ''
+    specs = []
     for result in patient_results:
-        print('INFO: Building specs with accession number: {} and machine table: {}'.format(result['accession_number'], result['results_table']))
-        specs += build_spec(conn, result['results_table'], result['accession_number'], date_time_reported, result['type'], s_request_time='04/06/2021')
+        specs.append(build_spec(spec_data, result['results_table'], result['accession_number'], date_time_reported, result['type'], s_request_time='04/06/2021'))
         # TODO -> replace s_request_time = real data
+    metrics.count('specs', len(specs))
+
+    # Formatting PDF
+    patient = patient_results[0]
+    header = __get_header()
+    title_date = __get_title_date(date_time_reported)
+    footer = __get_footer(date_time_reported, patient_id=patient_id, patient_name=patient['first_name'] + ' ' + patient['last_name'] + '.')
+    patient_info=__get_patient_info(patient['first_name'], patient['last_name'], patient['gender'], patient_id=patient_id)
+
+    if not PDF_SHARD_SPECS or len(specs) <= PDF_SHARD_SPECS:
+        return [source_html_template.render(style=css_style, header=header, title_date=title_date, 
+                                            patient_info=patient_info, specs=''.join(specs), footer=footer)], footer
+
+    # Footer is left out of shards, it is stamped on merged document so page numbers run across shards
+    html_shards = []
+    for start in range(0, len(specs), PDF_SHARD_SPECS):
+        if start > 0:
+            header = title_date = patient_info = ''
+        html_shards.append(source_html_template.render(style=css_style, header=header, title_date=title_date, 
+                                                       patient_info=patient_info, specs=''.join(specs[start:start + PDF_SHARD_SPECS]), footer=''))
+
+    return html_shards, footer
+
+
+def render_pdf(job):
+    """ Converts report HTML to PDF in memory, runs in worker process
+        Args: job(file_name, html_shards, footer, shard_workers)
+        Returns: (timings, PDF bytes, error)
+    """
+    file_name, html_shards, footer, shard_workers = job
+    pisa = cold_start.load_module('xhtml2pdf.pisa')
+    timings = {}
 
-    # Tmpdir for generating PDF
-    with tempfile.TemporaryDirectory() as tmpdir:
-        
-        # Report generated time
-        random_seconds = str(time()).split('.')[1]
-        datetime_iso_combined = strftime('%Y%m%d-%H%M%S', gmt_time)
-
-        # Building file name
-        file_name = '{patient_id}_{timestamp}_{seconds}.pdf'.format(patient_id=PATIENT_ID, timestamp=datetime_iso_combined, seconds=random_seconds)
-
-        # Openning file at location
-        output_filename = os.path.join(tmpdir, file_name)
-        result_file = open(output_filename, "w+b")
-        print('SUCCESS: File is opened! at location {}'.format(output_filename))
-        
-        # Formatting PDF
-        patient = patient_results[0]
-        header = __get_header()
-        title_date = __get_title_date(date_time_reported)
-        footer = __get_footer(date_time_reported, patient_id=PATIENT_ID, patient_name=patient['first_name'] + ' ' + patient['last_name'] + '.')
-        patient_info=__get_patient_info(patient['first_name'], patient['last_name'], patient['gender'], patient_id=PATIENT_ID)
-        
-
-        source_html_formatted = source_html.format(style=css_style, header=header, title_date=title_date, 
-                                                    patient_info=patient_info, specs=specs, footer=footer)
-        print('SUCCESS: SPEC is formmated!.')
+    try:
+        start = perf_counter()
+        result = io.BytesIO()
 
         # Converting HTML to PDF
-        pisa_status = pisa.CreatePDF(source_html_formatted, dest=result_file)
-        print('SUCCESS: PDF is generated!.')
+        if len(html_shards) == 1:
+            pisa_status = pisa.CreatePDF(html_shards[0], dest=result)
+            print('INFO: Status {}'.format(pisa_status.err))
+        else:
+            shards = process_pool.map_in_processes(render_shard, html_shards, shard_workers)
+            merge_shards(shards, footer, result)
+            print('INFO: PDF is merged from {} shards'.format(len(shards)))
 
-        # close output file
-        result_file.close() 
-        print('INFO: Status {}'.format(pisa_status.err))
+        timings['render_pdf'] = perf_counter() - start
 
-        s3.upload_file(output_filename, BUCKET_NAME, '{}/cumulative_report/{}'.format(LAB_NAME, file_name))
-        print('SUCCESS: PDF is uploaded to Bucket!')
-        
-        # Insert into report_cumulative
-        date_report_time_table = strftime('%Y-%m-%d-%H-%M', gmt_time)
+    except Exception as e:
+        return timings, None, '{}: {}'.format(type(e).__name__, e)
 
-        report_data = (PATIENT_ID, patient_results[0]['created_by'], date_report_time_table, file_name)
-        
-        with conn.cursor() as cursor:
-            sql = """INSERT INTO report_cumulative (patient_id, created_by, created_at, filepath) 
-                      values (%s, %s, %s, %s);"""
-            cursor.execute(sql, report_data)
-            conn.commit()
-        print("SUCCESS: Report is written to DB!")
-        
+    return timings, result.getvalue(), None
 
-def build_spec(conn, machine_result_table_name, accession_number, date_time_reported, specimen_type, s_request_time):
-    """ Cases where each machine result must be formmatted differently """
 
-    spec = ''
+def upload_pdf(pdf, file_name):
+    """ Streams PDF bytes to S3, multipart when larger than UPLOAD_PART_SIZE
+        Returns: upload time in seconds
+    """
+    transfer = cold_start.load_module('boto3.s3.transfer')
+    transfer_config = transfer.TransferConfig(multipart_threshold=UPLOAD_PART_SIZE, multipart_chunksize=UPLOAD_PART_SIZE)
 
-    # Olympus spec
-    if machine_result_table_name == 'result_machine_olympus':
-        with conn.cursor() as cursor:
+    start = perf_counter()
+    cold_start.get_client('s3').upload_fileobj(io.BytesIO(pdf), BUCKET_NAME, '{}/cumulative_report/{}'.format(LAB_NAME, file_name), 
+                                               Config=transfer_config)
+    elapsed = perf_counter() - start
+    metrics.add_duration('upload', elapsed)
+
+    return elapsed
+
+
+def render_shard(source_html):
+    """ Converts one shard of report HTML to PDF bytes, runs in worker process """
+    pisa = cold_start.load_module('xhtml2pdf.pisa')
+    result = io.BytesIO()
+    pisa_status = pisa.CreatePDF(source_html, dest=result)
+    if pisa_status.err:
+        raise RuntimeError('FAIL: PDF shard is not generated! {} errors'.format(pisa_status.err))
+
+    return result.getvalue()
+
+
+def merge_shards(shards, footer, dest):
+    """ Merges shard PDFs in order and stamps footer with page number on every page
+        Args: shards(list of PDF bytes), footer(HTML from __get_footer), dest(file object)
+    """
+    pisa = cold_start.load_module('xhtml2pdf.pisa')
+    pypdf = cold_start.load_module('pypdf')
+
+    writer = pypdf.PdfWriter()
+    for shard in shards:
+        for page in pypdf.PdfReader(io.BytesIO(shard)).pages:
+            writer.add_page(page)
+
+    # Footer is rendered by same template on blank pages, one per merged page, so it matches whole report
+    page_count = len(writer.pages)
+    footer_pdf = io.BytesIO()
+    pisa_status = pisa.CreatePDF(source_html_template.render(style=css_style, header='', title_date='', patient_info='',
+                                                             specs='<pdf:nextpage />'.join(['&nbsp;'] * page_count), footer=footer),
+                                 dest=footer_pdf)
+
+    footer_pages = pypdf.PdfReader(io.BytesIO(footer_pdf.getvalue())).pages
+    if pisa_status.err or len(footer_pages) != page_count:
+        raise RuntimeError('FAIL: Footer is not generated for {} pages!'.format(page_count))
+
+    for page, footer_page in zip(writer.pages, footer_pages):
+        page.merge_page(footer_page)
+
+    writer.write(dest)
+
+
+def fetch_spec_data(conn, patient_results):
+    """ Fetches machine results for all accession numbers with fixed number of queries
+        Args: conn(DB connection), patient_results(rows of patient query)
+        Returns: dict of machine table name -> dict of accession number -> results,
+                 'max_ids' -> machine table name -> dict of accession number -> newest row id (spec cache fingerprint)
+    """
+    accession_numbers = {}
+    for result in patient_results:
+        accession_numbers.setdefault(result['results_table'], set()).add(str(result['accession_number']))
+
+    spec_data = {'result_machine_olympus': {}, 'result_machine_sciex': {},
+                 'result_machine_film_array': {}}
+    max_ids = spec_data['max_ids'] = {table_name: {} for table_name in list(spec_data)}
+
+    def in_list(values):
+        return ', '.join(['%s'] * len(values))
+
+    with conn.cursor() as cursor:
+
+        numbers = sorted(accession_numbers.get('result_machine_olympus', ()))
+        if numbers:
             sql = """
-                select amphetamine, barbiturates, benzodiazepine, cocaine, 
+                select id, accession_number, amphetamine, barbiturates, benzodiazepine, cocaine, 
                     methadone, opiates, oxycodone,phencyclidine_pcp, 
-                    thc_cooh, ecstacy_mdma from result_machine_olympus where accession_number=%s;"""
-            
-            cursor.execute(sql, (accession_number, ))
-            olympus_results = cursor.fetchall()
-
-            if len(olympus_results) == 0:
-                raise ValueError('FAIL: No olympus results with given accession number is found.!')
-                print('FAIL: No olympus results with given accession number is found.!')
+                    thc_cooh, ecstacy_mdma, raw_values from result_machine_olympus where accession_number in ({}) order by id;""".format(in_list(numbers))
 
-            for result in olympus_results:
-                spec += __get_olympus_spec(result, accession_number, specimen_type, s_request_time, date_time_reported)
+            cursor.execute(sql, numbers)
+            for result in cursor.fetchall():
+                accession_number = str(result.pop('accession_number'))
+                max_ids['result_machine_olympus'][accession_number] = result.pop('id')
+                spec_data['result_machine_olympus'].setdefault(accession_number, []).append(result)
 
-    
-    elif machine_result_table_name == 'result_machine_sciex':
-        with conn.cursor() as cursor:
+        numbers = sorted(accession_numbers.get('result_machine_sciex', ()))
+        if numbers:
             sql = """
-                select component_name, actual_concentration, calculated_concentration from result_machine_sciex 
-                where sample_name=%s;"""
-            
-            cursor.execute(sql, (accession_number, ))
-            sciex_results = cursor.fetchall()
-
-            if len(sciex_results) == 0:
-                raise ValueError('FAIL: No sciex results with given accession number is found.!')
-                print('FAIL: No sciex results with given accession number is found.!')
-
-            for result in sciex_results:
-                spec += __get_sciex_spec(result, accession_number, specimen_type, s_request_time, date_time_reported)
-    
-    elif machine_result_table_name == 'result_machine_film_array':
-        
-        with conn.cursor() as cursor:
+                select id, sample_name, component_name, actual_concentration, actual_concentration_raw,
+                    calculated_concentration, calculated_concentration_raw from result_machine_sciex 
+                where sample_name in ({}) order by id;""".format(in_list(numbers))
+
+            cursor.execute(sql, numbers)
+            for result in cursor.fetchall():
+                accession_number = str(result.pop('sample_name'))
+                max_ids['result_machine_sciex'][accession_number] = result.pop('id')
+                spec_data['result_machine_sciex'].setdefault(accession_number, []).append(result)
+
+        numbers = sorted(accession_numbers.get('result_machine_film_array', ()))
+        if numbers:
             sql = """
-                select test_id, test_name, test_identifier from result_machine_film_array 
-                where specimen_identifier=%s;"""
-            
-            cursor.execute(sql, (accession_number, ))
+                select test_id, test_name, test_identifier, specimen_identifier from result_machine_film_array 
+                where specimen_identifier in ({}) order by test_id;""".format(in_list(numbers))
+
+            cursor.execute(sql, numbers)
             film_array_results = cursor.fetchall()
 
-            if len(film_array_results) == 0:
-                raise ValueError('FAIL: No film_array results with given accession number is found.!')
-                print('FAIL: No film_array results with given accession number is found.!')
+            # Result groups of every test, then results of every group
+            groups = {}
+            test_ids = [film_array['test_id'] for film_array in film_array_results]
+            if test_ids:
+                sql = """select * from result_machine_film_array_group where test_id in ({}) order by result_group_id;""".format(
+                    in_list(test_ids))
+                cursor.execute(sql, test_ids)
+                for group in cursor.fetchall():
+                    groups.setdefault(group['test_id'], []).append({'result_group': group, 'results': []})
+
+            results_with_groups = {results_with_group['result_group']['result_group_id']: results_with_group
+                                   for test_groups in groups.values() for results_with_group in test_groups}
+            group_ids = list(results_with_groups)
+            if group_ids:
+                sql = """select * from result_machine_film_array_group_item where result_group_id in ({}) order by result_id;""".format(
+                    in_list(group_ids))
+                cursor.execute(sql, group_ids)
+                for item in cursor.fetchall():
+                    results_with_groups[item['result_group_id']]['results'].append(item)
 
-            # In case, there are multiple film_array with same accession number
             for film_array in film_array_results:
-                # This list of groups with its results
-                results_data = []
-
-                # Getting result groups
-                sql = """select * from result_machine_film_array_group where test_id=%s;"""
-                cursor.execute(sql, (film_array['test_id'], ))
-                film_array_group_results = cursor.fetchall()
-
-                for group in film_array_group_results:
-                    # Building group with its results
-                    results_with_group = {}
-                    results_with_group['result_group'] = group
-                    
-                    # Fethcing results of each group
-                    sql = """select * from result_machine_film_array_group_item where result_group_id=%s;"""
-                    cursor.execute(sql, (group['result_group_id'], ))
-                    film_array_group_items = cursor.fetchall()
-                    results_with_group['results'] = film_array_group_items
-
-                    results_data.append(results_with_group)
-                
-                # Building up spec
-                spec += __get_film_array_spec(film_array, results_data, accession_number, specimen_type, s_request_time, date_time_reported)
-        
-    
+                accession_number = str(film_array.pop('specimen_identifier'))
+                max_ids['result_machine_film_array'][accession_number] = film_array['test_id']
+                spec_data['result_machine_film_array'].setdefault(accession_number, []).append(
+                    (film_array, groups.get(film_array['test_id'], [])))
+
+    return spec_data
+
+
+def build_spec(spec_data, machine_result_table_name, accession_number, date_time_reported, specimen_type, s_request_time):
+    """ Returns spec of accession number, rendering it only when its fetched rows changed """
+
+    results = spec_data.get(machine_result_table_name, {}).get(str(accession_number), [])
+
+    # Rows come ordered by id, so last one seen is newest
+    max_id = spec_data.get('max_ids', {}).get(machine_result_table_name, {}).get(str(accession_number))
+    key = spec_cache.make_key(machine_result_table_name, accession_number, specimen_type, s_request_time, len(results), max_id)
+
+    spec = spec_cache.get(key)
+    if spec is None:
+        spec = render_spec(machine_result_table_name, results, accession_number, REPORTED_TIME_TOKEN, specimen_type, s_request_time)
+        spec_cache.put(key, spec)
+
+    return spec.replace(REPORTED_TIME_TOKEN, date_time_reported)
+
+
+def render_spec(machine_result_table_name, results, accession_number, date_time_reported, specimen_type, s_request_time):
+    """ Cases where each machine result must be formmatted differently """
+
+    spec = []
+
+    # Olympus spec
+    if machine_result_table_name == 'result_machine_olympus':
+        if len(results) == 0:
+            raise ValueError('FAIL: No olympus results with given accession number is found.!')
+
+        for result in results:
+            spec.append(__get_olympus_spec(result, accession_number, specimen_type, s_request_time, date_time_reported))
+
+    elif machine_result_table_name == 'result_machine_sciex':
+        if len(results) == 0:
+            raise ValueError('FAIL: No sciex results with given accession number is found.!')
+
+        for result in results:
+            spec.append(__get_sciex_spec(result, accession_number, specimen_type, s_request_time, date_time_reported))
+
+    elif machine_result_table_name == 'result_machine_film_array':
+        if len(results) == 0:
+            raise ValueError('FAIL: No film_array results with given accession number is found.!')
+
+        # In case, there are multiple film_array with same accession number
+        for film_array, results_data in results:
+            # Building up spec
+            spec.append(__get_film_array_spec(film_array, results_data, accession_number, specimen_type, s_request_time, date_time_reported))
+
     else:
         raise ValueError(
             'FAIL: Given unsupported machine result table name!. {}'.format(machine_result_table_name))
 
-    return spec
+    return ''.join(spec)
@@ -1,91 +1,174 @@
+import contextlib
 import sys
 import os
 import tempfile
 import xml
 import xml.etree.ElementTree as ET
 
-import boto3
-import pymysql
-
+import archive
+import cold_start
+import compression
 import database_helper as db_helper
+import metrics
+import s3_helper
 
 DB_HOST = os.environ['DB_HOST']
 DB_USERNAME = os.environ['DB_USERNAME']
 DB_PASSWORD = os.environ['DB_PASSWORD']
 DB_NAME = os.environ['DB_NAME']
 
-s3 = boto3.client('s3')
+# Streaming mode parses object body from S3 with iterparse, every testOrder of XML is written
+STREAMING = os.environ.get('STREAMING', 'false').lower() == 'true'
+
+# Parquet archive holds one flat row per result, written when ARCHIVE_TARGET is set
+FILM_ARRAY_ARCHIVE_COLUMNS = tuple((column_name, 'string') for column_name in (
+    'specimen_identifier', 'test_identifier', 'test_name', 'test_instrument_serial_number', 'result_group_code',
+    'result_group_name', 'result_test_code', 'result_test_name', 'value_type', 'observation_value', 'observation_name',
+    'operator_name', 'result_date_time'))
 
 
+@cold_start.report_init
+@metrics.instrumented('film-array-xml')
 def lambda_handler(event, context):
-    # Connection setup
+    # Connection setup, reused while the container stays warm
     try:
-        conn = pymysql.connect(DB_HOST, user=DB_USERNAME,
-                               passwd=DB_PASSWORD, db=DB_NAME,
-                               connect_timeout=5, charset='utf8mb4',
-                               cursorclass=pymysql.cursors.DictCursor)
+        with metrics.span('connect'):
+            conn = db_helper.get_connection(DB_HOST, DB_USERNAME, DB_PASSWORD, DB_NAME)
 
-    except pymysql.MySQLError as e:
+    except db_helper.MySQLError as e:
         print("FAIL: Unexpected error: Could not connect to MySQL instance.")
         print(e)
         sys.exit()
 
-    print("SUCCESS: Connection to RDS MySQL instance succeeded")
+    # Admin invocation {"migrate": true} applies every pending migration, table-copy ones included
+    if event.get('migrate'):
+        with metrics.span('migrate'):
+            return {'schema_version': db_helper.migrate(conn, DB_NAME, offline=True)}
+
+    # Creating tables and indexes in case, schema is behind
+    with metrics.span('migrate'):
+        db_helper.migrate(conn, DB_NAME)
+
+    # S3 event info, objects loaded before are skipped
+    with metrics.span('claim'):
+        objects = db_helper.claim_objects(conn, s3_helper.get_event_objects(event), db_helper.get_lease_seconds(context))
+    metrics.count('objects', len(objects))
+    loaded = []
+    object_archive = None
+
+    if STREAMING:
+        # Bodies are parsed with iterparse while they are read from S3, one object after another
+        results = ((source_bucket, key, etag, open_s3_object(source_bucket, key)) for source_bucket, key, etag in objects)
+        write_xml = write_streaming_object
+    else:
+        # Downloads and parses overlap on thread pool
+        results = s3_helper.map_objects(load_s3_object, objects)
+        write_xml = write_parsed_xml
+
+    try:
+        for source_bucket, key, etag, source in results:
+            object_archive = archive.open_archive('film-array', FILM_ARRAY_ARCHIVE_COLUMNS, key, etag)
+
+            # Streamed XML is parsed while it is written, so write includes parse time in streaming mode
+            with metrics.span('write'):
+                row_count = write_xml(source, conn, object_archive)
 
-    # Creating table in case, no tables
-    tables_exist = [db_helper.table_exists(conn, DB_NAME, table_name)
-                    for table_name in ('result_machine_film_array', 
-                    'result_machine_film_array_group', 'result_machine_film_array_group_item')]
+            # Commits whole XML in one transaction together with manifest row
+            with metrics.span('commit'):
+                db_helper.finish_ingest(conn, source_bucket, key, etag, row_count)
 
-    if not all(tables_exist):
-        print('INFO: No tables, creating.')
-        db_helper.create_film_array_tables(conn)
-        print('SUCCESS: Tables created.')
+            if object_archive:
+                object_archive.close()
 
-    # S3 event info
-    source_bucket = event['Records'][0]['s3']['bucket']['name']
-    key = event['Records'][0]['s3']['object']['key']
-    print('SUCCESS : Object was uploaded: {}'.format(key))
+            metrics.count('rows', row_count)
+            loaded.append((source_bucket, key, etag))
+
+    except Exception:
+        if object_archive:
+            object_archive.discard()
+        db_helper.fail_ingest(conn, [obj for obj in objects if obj not in loaded])
+        raise
+
+
+@contextlib.contextmanager
+def open_s3_object(source_bucket, key):
+    """ Opens body of uploaded object for iterparse, without downloading it first, body is closed on exit
+        Args: source_bucket, key
+        Returns: context manager of streaming body, decompressing one for .gz/.zst/.zip uploads
+    """
+    with metrics.span('download'):
+        response = cold_start.get_client('s3').get_object(Bucket=source_bucket, Key=key)
+    metrics.count('bytes', response['ContentLength'])
 
+    body = response['Body']
+    try:
+        with compression.open_decompressed(body, key) as (content_name, source):
+            yield source
+    finally:
+        body.close()
+
+
+def write_streaming_object(s3_object, conn, object_archive=None):
+    """ Opens S3 object only when it is written, so bodies of objects not reached are never opened
+        Args: s3_object(context manager open_s3_object returns), conn(DB connection), object_archive(ArchiveWriter or None)
+        Returns: number of results written
+    """
+    with s3_object as source:
+        return write_streaming_xml(source, conn, object_archive)
+
+
+def load_s3_object(source_bucket, key):
+    """ Downloads and parses one uploaded xml
+        Args: source_bucket, key
+        Returns: root(XML element)
+    """
     # Temporary location for storing s3 object
     with tempfile.TemporaryDirectory() as tmpdir:
         file_name = key.split('/')[-1]
 
         download_path = os.path.join(tmpdir, file_name)
-        print('SUCCESS: TEMPDIR has been created')
 
-        s3.download_file(source_bucket, key, download_path)
-        print('SUCCESS: S3 Object has been downloaded')
+        with metrics.span('download'):
+            cold_start.get_client('s3').download_file(source_bucket, key, download_path)
+        metrics.count('bytes', os.path.getsize(download_path))
 
         # Parsing xml file
         try:
-            tree = ET.parse(download_path)
+            with metrics.span('parse'), open(download_path, 'rb') as xml_file, \
+                    compression.open_decompressed(xml_file, download_path) as (content_name, source):
+                tree = ET.parse(source)
             root = tree.getroot()
         except FileNotFoundError as e:
             print('FAIL: File not found!')
             print(e)
+            raise
         except xml.etree.ElementTree.ParseError as e:
             print('FAIL: Error when parsing xml')
             print(e)
+            raise
 
-        print('SUCCESS: XML has been parsed.')
+        return root
 
-        # Writing to filmArrayTest
-        film_array_test_id = write_to_result_machine_film_array(root, conn)
-        print('SUCCESS: filmArrayTest is written.')
 
-        # Writing Result and Result Group
-        test = root.find('requestResult').find('testOrder').find('test')
-        result_groups = test.findall('resultGroup')
+def write_parsed_xml(root, conn, object_archive=None):
+    """ Writes first test of parsed XML with its groups and results
+        Args: root(XML element), conn(DB connection), object_archive(ArchiveWriter or None)
+        Returns: number of results written
+    """
+    # Writing to filmArrayTest
+    film_array_test_id = write_to_result_machine_film_array(root, conn)
 
-        for result_group in result_groups:
-            write_to_result_machine_film_array_group(result_group, conn, film_array_test_id)
+    # Writing Result and Result Group
+    test_order = root.find('requestResult').find('testOrder')
+    test = test_order.find('test')
+    result_groups = test.findall('resultGroup')
 
-        print('SUCCESS: ResultGroup and Result has been written.')
+    row_count = write_to_result_machine_film_array_group(result_groups, conn, film_array_test_id)
 
-    print('SUCCESS: DONE')
+    if object_archive:
+        object_archive.write_batch(get_archive_rows(test_order, test))
 
-    conn.close()
+    return row_count
 
 
 def write_to_result_machine_film_array(root, conn):
@@ -98,7 +181,32 @@ def write_to_result_machine_film_array(root, conn):
     request_result = root.find('requestResult')
     test_order = request_result.find('testOrder')
     test = test_order.find('test')
+    request_status = request_result.find('requestStatus').text
+
+    return write_film_array_test(conn, get_header_data(header), request_status, test_order, test)
+
+
+def get_header_data(header):
+    """ Reads header info shared by every test of XML
+        Args: header(XML element)
+        Returns: tuple of header values
+    """
+    header_info_sender_name = header.find('senderName').text
+    header_info_processing_identifier = header.find('processingIdentifier').text
+    header_info_version = header.find('version').text
+    header_info_date_time = header.find('dateTime').text
+    header_info_message_type = header.find('messageType').text
+
+    return (header_info_sender_name, header_info_processing_identifier, header_info_version,
+            header_info_date_time, header_info_message_type)
 
+
+def write_film_array_test(conn, header_data, request_status, test_order, test):
+    """ Writes one test to result_machine_film_array
+        Args: conn(DB connection), header_data(tuple from get_header_data), request_status,
+              test_order(XML element), test(XML element)
+        Returns: id inserted to film_array_test
+    """
     specimen_identifier = test_order.find('specimen').find('specimenIdentifier').text
     test_identifier = test.find('universalIdentifier').find('testIdentifier').text
     test_name = test.find('universalIdentifier').find('testName').text
@@ -112,18 +220,9 @@ def write_to_result_machine_film_array(root, conn):
     disposable_type = disposable_data.find('disposableType').text
     disposable_lot_number = disposable_data.find('lotNumber').text
 
-    header_info_sender_name = header.find('senderName').text
-    header_info_processing_identifier = header.find('processingIdentifier').text
-    header_info_version = header.find('version').text
-    header_info_date_time = header.find('dateTime').text
-    header_info_message_type = header.find('messageType').text
-    request_status = request_result.find('requestStatus').text
-
     dataset = (specimen_identifier, test_identifier, test_name, test_version,
                test_instrument_type, test_instrument_serial_number, disposable_identifier,
-               disposable_reference, disposable_type, disposable_lot_number,
-               header_info_sender_name, header_info_processing_identifier, header_info_version,
-               header_info_date_time, header_info_message_type, request_status)
+               disposable_reference, disposable_type, disposable_lot_number) + header_data + (request_status, )
 
     sql = """INSERT INTO result_machine_film_array 
               (specimen_identifier, test_identifier, test_name, test_version, test_instrument_type, 
@@ -134,39 +233,136 @@ def write_to_result_machine_film_array(root, conn):
 
     with conn.cursor() as cursor:
         cursor.execute(sql, dataset)
-        conn.commit()
         return cursor.lastrowid
 
 
-def write_to_result_machine_film_array_group(result_group, conn, film_array_test_id):
-    """ Writes to result_machine_film_array_group table
-        Args: result_group(XML element), conn(DB connection), film_array_test_id
-        Returns: id inserted to result_group table
+def write_streaming_xml(source, conn, object_archive=None):
+    """ Parses XML incrementally, writing every test of each testOrder as soon as testOrder closes
+        Args: source(file object or path), conn(DB connection), object_archive(ArchiveWriter or None)
+        Returns: number of results written
     """
-    result_group_code = result_group.find('resultGroupCode').text
-    result_group_name = result_group.find('resultGroupName').text
-    result_group_coding_system = result_group.find('resultGroupCodingSystem').text
+    header_data = None
+    request_status = None
+    # Tests written before requestStatus of their requestResult was read
+    pending_test_ids = []
+    row_count = 0
+
+    path = []
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(element)
+            continue
+
+        path.pop()
+        parent = path[-1] if path else None
+        parent_tag = parent.tag if parent is not None else None
+
+        if element.tag == 'header' and len(path) == 1:
+            header_data = get_header_data(element)
+
+        elif element.tag == 'requestStatus' and parent_tag == 'requestResult':
+            request_status = element.text
+
+            if pending_test_ids:
+                with conn.cursor() as cursor:
+                    sql = """UPDATE result_machine_film_array SET request_status=%s WHERE test_id IN ({});""".format(
+                        ', '.join(['%s'] * len(pending_test_ids)))
+                    cursor.execute(sql, [request_status] + pending_test_ids)
+                pending_test_ids = []
+
+        elif element.tag == 'testOrder' and parent_tag == 'requestResult':
+            if header_data is None:
+                raise ValueError('FAIL: testOrder found before XML header!')
+
+            for test in element.findall('test'):
+                film_array_test_id = write_film_array_test(conn, header_data, request_status, element, test)
+                row_count += write_to_result_machine_film_array_group(test.findall('resultGroup'), conn, film_array_test_id)
+
+                if object_archive:
+                    object_archive.write_batch(get_archive_rows(element, test))
+
+                if request_status is None:
+                    pending_test_ids.append(film_array_test_id)
+
+        elif element.tag == 'requestResult':
+            request_status = None
+            pending_test_ids = []
+
+        else:
+            continue
+
+        # Processed elements are dropped, so memory stays flat on large exports
+        element.clear()
+        if parent is not None:
+            parent.remove(element)
+
+    return row_count
+
+
+def get_archive_rows(test_order, test):
+    """ Flattens results of test with their specimen, test and group, in FILM_ARRAY_ARCHIVE_COLUMNS order
+        Args: test_order(XML element), test(XML element)
+        Returns: list of row tuples
+    """
+    test_data = (test_order.find('specimen').find('specimenIdentifier').text,
+                 test.find('universalIdentifier').find('testIdentifier').text,
+                 test.find('universalIdentifier').find('testName').text,
+                 test.find('instrumentSerialNumber').text)
+
+    rows = []
+    for result_group in test.findall('resultGroup'):
+        group_data = (result_group.find('resultGroupCode').text, result_group.find('resultGroupName').text)
+
+        for result in result_group.findall('result'):
+            test_result = result.find('value').find('testResult')
+            rows.append(test_data + group_data + (
+                result.find('resultID').find('resultTestCode').text, result.find('resultID').find('resultTestName').text,
+                test_result.find('valueType').text, test_result.find('observationValue').text,
+                test_result.find('observationName').text, result.find('operatorName').text, result.find('resultDateTime').text))
+
+    return rows
+
+
+def write_to_result_machine_film_array_group(result_groups, conn, film_array_test_id):
+    """ Writes all result groups of test with one multi-row insert, then their results
+        Args: result_groups(XML elements), conn(DB connection), film_array_test_id
+        Returns: number of results written
+    """
+    datasets = []
+    for result_group in result_groups:
+        result_group_code = result_group.find('resultGroupCode').text
+        result_group_name = result_group.find('resultGroupName').text
+        result_group_coding_system = result_group.find('resultGroupCodingSystem').text
+
+        datasets.append((result_group_code, result_group_name, result_group_coding_system, film_array_test_id))
 
     sql = """INSERT INTO result_machine_film_array_group (result_group_code, result_group_name, result_group_coding_system, test_id)
              VALUES (%s, %s, %s, %s)"""
 
     with conn.cursor() as cursor:
-        cursor.execute(sql, (result_group_code, result_group_name, result_group_coding_system, film_array_test_id))
-        conn.commit()
-        result_group_id = cursor.lastrowid
+        cursor.executemany(sql, datasets)
+
+        # Generated ids are resolved in bulk, ascending ids follow insert order
+        sql = """select result_group_id from result_machine_film_array_group where test_id=%s order by result_group_id;"""
+        cursor.execute(sql, (film_array_test_id, ))
+        result_group_ids = [row['result_group_id'] for row in cursor.fetchall()]
+
+    # Writing Result of every group at once
+    results = [(result, result_group_id)
+               for result_group, result_group_id in zip(result_groups, result_group_ids)
+               for result in result_group.findall('result')]
+    write_to_result_machine_film_array_group_item(results, conn)
 
-    # Writing Result
-    results = result_group.findall('result')
-    write_to_result_machine_film_array_group_item(results, conn, result_group_id)
+    return len(results)
 
 
-def write_to_result_machine_film_array_group_item(results, conn, result_group_id):
+def write_to_result_machine_film_array_group_item(results, conn):
     """ Writes to write_to_result_machine_film_array_group_item table
-        Args: result(XML element), conn(DB connection), result_group_id
-        Returns: id inserted to result table
+        Args: results(list of (XML element, result_group_id)), conn(DB connection)
+        Returns: None
     """
     datasets = []
-    for result in results:
+    for result, result_group_id in results:
         result_test_code = result.find('resultID').find('resultTestCode').text
         result_test_name = result.find('resultID').find('resultTestName').text
         result_coding_system = result.find('resultID').find('resultCodingSystem').text
@@ -187,4 +383,3 @@ def write_to_result_machine_film_array_group_item(results, conn, result_group_id
 
     with conn.cursor() as cursor:
         cursor.executemany(sql, datasets)
-        conn.commit()
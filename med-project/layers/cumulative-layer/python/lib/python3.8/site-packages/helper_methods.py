@@ -1,5 +1,8 @@
 """ Helper methods for cumulative report lambda """
 from datetime import datetime
+from decimal import Decimal
+
+from report_templates import Template
 
 
 source_html = """
@@ -18,6 +21,8 @@ source_html = """
   </body>
   </html>"""
 
+source_html_template = Template(source_html)
+
 css_style = """
   
   @page {
@@ -186,15 +191,7 @@ css_style = """
     }"""
 
 
-def __get_header(lab_location=None, lab_name=None):
-  
-  if not lab_location:
-    lab_location = 'University Medical Center, Dept. of Pathology<br>123 University Way, City, ST 12345'
-  
-  if not lab_name:
-    lab_name = 'LABASOS'
-
-  return """
+header_template = Template("""
     <header class="hdr">
       <table style="width: 100%;">
         <tr>
@@ -213,24 +210,37 @@ def __get_header(lab_location=None, lab_name=None):
         </tr>
       </table>
     </header>
-  """.format(location=lab_location, name=lab_name)
+  """)
 
 
-def __get_title_date(date_time_reported, report_title=None):
+def __get_header(lab_location=None, lab_name=None):
+  
+  if not lab_location:
+    lab_location = 'University Medical Center, Dept. of Pathology<br>123 University Way, City, ST 12345'
+  
+  if not lab_name:
+    lab_name = 'LABASOS'
+
+  return header_template.render(location=lab_location, name=lab_name)
 
-  if not report_title:
-    report_title = 'Cumulative report'
 
-  return """ 
+title_date_template = Template(""" 
     <section class="hero">
       <div class="hero-title">{report_title}</div>
       <div class="hero-reportData">Report Date/Time: <span class="reportData">{date_time_reported}</span></div>
     </section>
-  """.format(report_title=report_title, date_time_reported=date_time_reported)
+  """)
 
 
-def __get_footer(date_time_reported, patient_id=9895646, patient_name='Doe John Q.'):
-  return """
+def __get_title_date(date_time_reported, report_title=None):
+
+  if not report_title:
+    report_title = 'Cumulative report'
+
+  return title_date_template.render(report_title=report_title, date_time_reported=date_time_reported)
+
+
+footer_template = Template("""
     <div id="footer_content">
       <span style="font-size:12px;">Page <pdf:pagenumber></span>
       &nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;
@@ -245,17 +255,14 @@ def __get_footer(date_time_reported, patient_id=9895646, patient_name='Doe John
       <span style="font-size:12px;display:inline-block;padding-left:50px;">
       {patient_name} &nbsp;&nbsp;&nbsp;&nbsp;&nbsp; {patient_id} &nbsp;&nbsp;&nbsp;&nbsp;&nbsp; {date}</div>
     </div>
-  """.format(patient_name=patient_name, patient_id=patient_id, date=date_time_reported)
+  """)
 
 
-def __get_patient_info(first_name, last_name, sex, patient_id='987654321', dob='2000-04-16', status='Routine', ordering_dr='Smith, Peter MD'):
-  current_year = datetime.now().year
-  age = current_year - int(dob.split('-')[0])
-  sex = 'M' if sex.lower() == 'male' else 'F'
-  dob_iso = dob.split('-')
-  dob = '{}/{}/{}'.format(dob_iso[1], dob_iso[2], dob_iso[0])
+def __get_footer(date_time_reported, patient_id=9895646, patient_name='Doe John Q.'):
+  return footer_template.render(patient_name=patient_name, patient_id=patient_id, date=date_time_reported)
 
-  return """ 
+
+patient_info_template = Template(""" 
     <section class="patient">
       <div class="patient-title">Patient info</div>
       <table class="patient__table">
@@ -273,42 +280,33 @@ def __get_patient_info(first_name, last_name, sex, patient_id='987654321', dob='
         </tr>
       </table>
     </section>
-  """.format(first_name=first_name, last_name=last_name, status=status, patient_id=patient_id, 
-            ordering_dr=ordering_dr, age=age, sex=sex, dob=dob)
-  
+  """)
 
-def __get_olympus_spec(olympus_data, accession_number, specimen_type, service_request_time, generated_time):
 
-  if not len(olympus_data) == 10:
-    raise ValueError('FAIL: Olympus data must be dict with length of 10 items!')
+def __get_patient_info(first_name, last_name, sex, patient_id='987654321', dob='2000-04-16', status='Routine', ordering_dr='Smith, Peter MD'):
+  current_year = datetime.now().year
+  age = current_year - int(dob.split('-')[0])
+  sex = 'M' if sex.lower() == 'male' else 'F'
+  dob_iso = dob.split('-')
+  dob = '{}/{}/{}'.format(dob_iso[1], dob_iso[2], dob_iso[0])
 
-  cut_off_values = {'amphetamine': 1000, 'barbiturates': 200, 
-                    'benzodiazepine': 200, 'cocaine': 150, 
-                    'methadone': 300, 'opiates': 300, 
-                    'oxycodone': 100, 'phencyclidine_pcp': 25, 
-                    'thc_cooh': 50, 'ecstacy_mdma': 500}
+  return patient_info_template.render(first_name=first_name, last_name=last_name, status=status, patient_id=patient_id, 
+            ordering_dr=ordering_dr, age=age, sex=sex, dob=dob)
   
-  display_values = {'amphetamine': 'Amphetamine', 'barbiturates': 'Barbiturates', 
-                    'benzodiazepine': 'Benzodiazepine', 'cocaine': 'Cocaine', 
-                    'methadone': 'Methadone', 'opiates': 'Opiates', 
-                    'oxycodone': 'Oxycodone', 'phencyclidine_pcp': 'Phencyclidine(PCP)', 
-                    'thc_cooh': 'THC-COOH', 'ecstacy_mdma': 'Ecstacy(MDMA)'}
 
-  test_rows = ''
-  for key, value in olympus_data.items():
+olympus_cut_off_values = {'amphetamine': 1000, 'barbiturates': 200, 
+                          'benzodiazepine': 200, 'cocaine': 150, 
+                          'methadone': 300, 'opiates': 300, 
+                          'oxycodone': 100, 'phencyclidine_pcp': 25, 
+                          'thc_cooh': 50, 'ecstacy_mdma': 500}
 
-    try:
-      flag = 'L' if float(value) < cut_off_values[key] else 'H'
-
-    except KeyError:
-      print('FAIL: Olympus data is missing value! {}'.format(olympus_data))
-      raise
-    
-    except ValueError:
-      print('FAIL: Error when parsing concentration! -> {}'.format(value))
-      raise
+olympus_display_values = {'amphetamine': 'Amphetamine', 'barbiturates': 'Barbiturates', 
+                          'benzodiazepine': 'Benzodiazepine', 'cocaine': 'Cocaine', 
+                          'methadone': 'Methadone', 'opiates': 'Opiates', 
+                          'oxycodone': 'Oxycodone', 'phencyclidine_pcp': 'Phencyclidine(PCP)', 
+                          'thc_cooh': 'THC-COOH', 'ecstacy_mdma': 'Ecstacy(MDMA)'}
 
-    test_rows += """
+olympus_test_row_template = Template("""
         <tr>
           <td style="width: 50%;"><span class="test">{test_name}</span></td>
           <td style="padding-left:5px;"><span>{concentration}</span></td>
@@ -316,10 +314,9 @@ def __get_olympus_spec(olympus_data, accession_number, specimen_type, service_re
           <td style="padding-left:15px;"><span>{cut_off_value}</span></td>
           <td style="text-align:center;"><span>ng/mL</span></td>
         </tr>
-    """.format(test_name=display_values[key], concentration=value, flag=flag, cut_off_value=cut_off_values[key])
+    """)
 
-
-  return """ 
+olympus_spec_template = Template(""" 
     <section class="spec">
       <div class="spec-header" style="line-height:2px;">
         <div class="spec-title">SPEC # <span class="spec-id">{accession_number}</span></div>
@@ -358,12 +355,54 @@ def __get_olympus_spec(olympus_data, accession_number, specimen_type, service_re
           Comment: <span class="comment">**Critical results Hgb of 7.0 and Hct of 21.1 reported to Dr. J Smith at 15:15 on 2/10/14 by M. Peters</span>
         </div>
       </div>
-    </section>""".format(accession_number=accession_number, service_request_time=service_request_time, 
-      generated_time=generated_time, specimen_type=specimen_type, tests=test_rows)
+    </section>""")
 
 
-def __get_sciex_spec(sciex_data, accession_number, specimen_type, service_request_time, generated_time):
-  return """ 
+def __format_concentration(value, raw=None):
+  """ Instrument text as sent (12.50, N/A) when row has it. Otherwise number of typed column as its repr,
+      exponent written out, which gives back text database_helper.parse_number left no raw text for
+  """
+  if raw is not None:
+    return raw
+
+  text = repr(value)
+  return '{:f}'.format(Decimal(text)) if 'e' in text else text
+
+
+def __get_olympus_spec(olympus_data, accession_number, specimen_type, service_request_time, generated_time):
+
+  # Values as sent, in column order, NULL typed value where instrument sent no number
+  raw_values = olympus_data.get('raw_values')
+  raw_values = raw_values.split(' ') if raw_values else [None] * len(olympus_display_values)
+
+  if not len(raw_values) == len(olympus_display_values):
+    raise ValueError('FAIL: Olympus data must hold 10 values!')
+
+  test_rows = []
+  for (key, test_name), raw in zip(olympus_display_values.items(), raw_values):
+    try:
+      value = olympus_data[key]
+
+    except KeyError:
+      print('FAIL: Olympus data is missing value! {}'.format(olympus_data))
+      raise
+
+    if value is None and raw is None:
+      print('FAIL: Error when parsing concentration! -> {}'.format(olympus_data))
+      raise ValueError('FAIL: Olympus concentration is missing!')
+
+    # Text such as >1000 has no flag
+    flag = '' if value is None else 'L' if value < olympus_cut_off_values[key] else 'H'
+
+    olympus_test_row_template.render_into(test_rows, test_name=test_name, concentration=__format_concentration(value, raw),
+                                          flag=flag, cut_off_value=olympus_cut_off_values[key])
+
+
+  return olympus_spec_template.render(accession_number=accession_number, service_request_time=service_request_time, 
+      generated_time=generated_time, specimen_type=specimen_type, tests=''.join(test_rows))
+
+
+sciex_spec_template = Template(""" 
     <section class="spec">
       <div class="spec-header" style="line-height:2px;">
         <div class="spec-title">SPEC # <span class="spec-id">{accession_number}</span></div>
@@ -401,25 +440,26 @@ def __get_sciex_spec(sciex_data, accession_number, specimen_type, service_reques
           Comment: <span class="comment">**Critical results Hgb of 7.0 and Hct of 21.1 reported to Dr. J Smith at 15:15 on 2/10/14 by M. Peters</span>
         </div>
       </div>
-    </section>""".format(accession_number=accession_number, service_request_time=service_request_time, generated_time=generated_time, 
-    specimen_type=specimen_type, component_name=sciex_data['component_name'], actual_concentration=sciex_data['actual_concentration'],
-    calculated_concentration=sciex_data['calculated_concentration'])
+    </section>""")
 
 
-def __get_film_array_spec(film_array_data, group_with_result_data, accession_number, specimen_type, service_request_time, generated_time):
-  def __get_group_with_items_spec(group_with_results):
-    """ Function for building group result spec """
+def __get_sciex_spec(sciex_data, accession_number, specimen_type, service_request_time, generated_time):
+  actual_concentration = __format_concentration(sciex_data['actual_concentration'], sciex_data['actual_concentration_raw'])
+  calculated_concentration = __format_concentration(sciex_data['calculated_concentration'], sciex_data['calculated_concentration_raw'])
 
-    results = ''
-    for result in group_with_results['results']:
-      results += """ 
+  return sciex_spec_template.render(accession_number=accession_number, service_request_time=service_request_time, generated_time=generated_time, 
+    specimen_type=specimen_type, component_name=sciex_data['component_name'], actual_concentration=actual_concentration,
+    calculated_concentration=calculated_concentration)
+
+
+film_array_result_row_template = Template(""" 
         <tr>
           <td style="width: 70%;"><span class="test">{result_name}</span></td>
           <td style="width:30%;"><p style="background-color:#00A3B9;color:white;text-align:center;">{observation_name}</p></td>
         </tr>
-      """.format(result_name=result['result_test_name'], observation_name=result['observation_name'], value_type=result['value_type'])
+      """)
 
-    return """ 
+film_array_group_template = Template(""" 
       <div class="spec__table_name"><b>Group: </b> {group_name}</div>
       <table class="spec__table" style="margin-bottom:25px;">
         <tr>
@@ -428,14 +468,9 @@ def __get_film_array_spec(film_array_data, group_with_result_data, accession_num
         </tr>
         {results}
       </table>
-    """.format(group_name=group_with_results['result_group']['result_group_name'], results=results)
-
-  # Building results with group
-  results = ''
-  for result_data in group_with_result_data:
-    results += __get_group_with_items_spec(result_data)
+    """)
 
-  return """ 
+film_array_spec_template = Template(""" 
     <section class="spec">
       <div class="spec-header" style="line-height:2px;">
         <div class="spec-title">SPEC # <span class="spec-id">{accession_number}</span></div>
@@ -466,7 +501,26 @@ def __get_film_array_spec(film_array_data, group_with_result_data, accession_num
           Comment: <span class="comment">**Critical results Hgb of 7.0 and Hct of 21.1 reported to Dr. J Smith at 15:15 on 2/10/14 by M. Peters</span>
         </div>
       </div>
-    </section>""".format(accession_number=accession_number, service_request_time=service_request_time, generated_time=generated_time,
+    </section>""")
+
+
+def __get_film_array_spec(film_array_data, group_with_result_data, accession_number, specimen_type, service_request_time, generated_time):
+  def __get_group_with_items_spec(group_with_results, parts):
+    """ Function for building group result spec """
+
+    results = []
+    for result in group_with_results['results']:
+      film_array_result_row_template.render_into(results, result_name=result['result_test_name'], 
+                                                 observation_name=result['observation_name'], value_type=result['value_type'])
+
+    return film_array_group_template.render_into(parts, group_name=group_with_results['result_group']['result_group_name'], 
+                                                 results=''.join(results))
+
+  # Building results with group
+  results = []
+  for result_data in group_with_result_data:
+    __get_group_with_items_spec(result_data, results)
+
+  return film_array_spec_template.render(accession_number=accession_number, service_request_time=service_request_time, generated_time=generated_time,
                         specimen_type=specimen_type, test_name=film_array_data['test_name'], test_identifier=film_array_data['test_identifier'],
-                        results=results)
-  
\ No newline at end of file
+                        results=''.join(results))
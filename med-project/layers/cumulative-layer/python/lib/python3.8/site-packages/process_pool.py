@@ -0,0 +1,66 @@
+""" Process pool for Lambda, which has no /dev/shm for multiprocessing.Pool and Queue """
+import os
+import multiprocessing
+
+
+def available_cpus():
+  """ Number of vCPUs this container may run on """
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return os.cpu_count() or 1
+
+
+def map_in_processes(func, items, workers):
+  """ Runs func for every item across forked worker processes
+      Args: func, items(list), workers(number of processes)
+      Returns: list of results in item order
+  """
+  if workers <= 1 or len(items) <= 1:
+    return [func(item) for item in items]
+
+  context = multiprocessing.get_context('fork')
+  workers = min(workers, len(items))
+
+  processes = []
+  for worker in range(workers):
+    indexes = range(worker, len(items), workers)
+    receiver, sender = context.Pipe(duplex=False)
+
+    process = context.Process(target=_run_worker, args=(func, [items[i] for i in indexes], sender))
+    process.start()
+    sender.close()
+    processes.append((process, receiver, indexes))
+
+  results = [None] * len(items)
+  error = None
+
+  # Pipes are drained before join, so big results do not block workers
+  for process, receiver, indexes in processes:
+    try:
+      succeeded, payload = receiver.recv()
+    except EOFError:
+      succeeded, payload = False, RuntimeError('FAIL: Worker process died!')
+
+    receiver.close()
+    process.join()
+
+    if succeeded:
+      for index, result in zip(indexes, payload):
+        results[index] = result
+    elif error is None:
+      error = payload
+
+  if error is not None:
+    raise error
+
+  return results
+
+
+def _run_worker(func, items, sender):
+  try:
+    sender.send((True, [func(item) for item in items]))
+  except Exception as e:
+    sender.send((False, e))
+  finally:
+    sender.close()
@@ -0,0 +1,31 @@
+""" Precompiled templates for cumulative report fragments """
+from string import Formatter
+
+
+_conversions = {'r': repr, 's': str, 'a': ascii}
+
+
+class Template:
+  """ str.format template parsed once at import, rendered into list of parts """
+
+  def __init__(self, source):
+    self.fields = []
+    for literal, field_name, format_spec, conversion in Formatter().parse(source):
+      self.fields.append((literal, field_name, format_spec, _conversions.get(conversion)))
+
+  def render_into(self, parts, **values):
+    """ Appends rendered template to parts, same output as source.format(**values) """
+    for literal, field_name, format_spec, conversion in self.fields:
+      if literal:
+        parts.append(literal)
+
+      if field_name is not None:
+        value = values[field_name]
+        if conversion:
+          value = conversion(value)
+        parts.append(format(value, format_spec))
+
+    return parts
+
+  def render(self, **values):
+    return ''.join(self.render_into([], **values))
@@ -0,0 +1,34 @@
+""" Cache of rendered spec fragments, keyed by fingerprint of fetched rows """
+from collections import OrderedDict
+
+
+# Rendered in place of report time, so one fragment serves every later report
+REPORTED_TIME_TOKEN = '@@REPORTED_TIME@@'
+
+
+class SpecCache:
+  """ In-memory LRU tier for warm containers. Result rows are insert only, so row count and newest row id
+      the DB returns tell whether rows changed, without hashing them. No persistent tier: reading one
+      fragment from /tmp or S3 costs more than rendering it
+  """
+
+  def __init__(self, max_entries=2048):
+    self.entries = OrderedDict()
+    self.max_entries = max_entries
+
+  def make_key(self, machine_result_table_name, accession_number, specimen_type, service_request_time, row_count, max_id):
+    """ Key of fragment, changes whenever rows of accession number or other rendered values change """
+    return (machine_result_table_name, str(accession_number), specimen_type, service_request_time, row_count, max_id)
+
+  def get(self, key):
+    spec = self.entries.get(key)
+    if spec is not None:
+      self.entries.move_to_end(key)
+    return spec
+
+  def put(self, key, spec):
+    self.entries[key] = spec
+    self.entries.move_to_end(key)
+
+    if len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
@@ -0,0 +1,118 @@
+""" Parquet copies of ingested batches for analytics, partitioned by instrument and ingest date """
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+
+import cold_start
+import metrics
+
+
+# s3://bucket/prefix or local directory (for testing), archive is off when not set
+ARCHIVE_TARGET = os.environ.get('ARCHIVE_TARGET')
+
+
+def open_archive(instrument, columns, key, etag, target=ARCHIVE_TARGET):
+    """ Starts archive file of one ingested object
+        Args: instrument(partition value, e.g. sciex), columns(list of (name, Arrow type alias e.g. string, double)),
+              key(S3 key of ingested object), etag, target
+        Returns: ArchiveWriter, None when archive is off
+    """
+    if not target:
+        return None
+    return ArchiveWriter(target, instrument, columns, key, etag)
+
+
+class ArchiveWriter:
+    """ Writes every batch of one ingested object as row group of one Parquet file:
+        <target>/instrument=<instrument>/date=<yyyy-mm-dd>/<file name>-<etag>.parquet.
+        File is published on close only. Archive is best effort, its failure is logged and counted, ingest goes on
+    """
+
+    def __init__(self, target, instrument, columns, key, etag):
+        self.target = target
+        self.columns = columns
+        self.path = 'instrument={}/date={:%Y-%m-%d}/{}-{}.parquet'.format(
+            instrument, datetime.now(timezone.utc), key.split('/')[-1], etag)
+
+        self.rows = 0
+        self.failed = False
+        self.schema = None
+        self._writer = None
+        self._tmp_path = None
+
+    def write_batch(self, batch):
+        """ Appends batch of row tuples, in column order """
+        if self.failed or not batch:
+            return
+
+        try:
+            with metrics.span('archive'):
+                pa = cold_start.load_module('pyarrow')
+
+                if self._writer is None:
+                    parquet = cold_start.load_module('pyarrow.parquet')
+                    self.schema = pa.schema([(name, pa.type_for_alias(type_alias)) for name, type_alias in self.columns])
+
+                    file_descriptor, self._tmp_path = tempfile.mkstemp(suffix='.parquet')
+                    os.close(file_descriptor)
+                    self._writer = parquet.ParquetWriter(self._tmp_path, self.schema, compression='snappy')
+
+                arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*batch), self.schema)]
+                self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+            self.rows += len(batch)
+
+        except Exception as e:
+            self.fail(e)
+
+    def close(self):
+        """ Publishes file to target once object is committed
+            Returns: path of published file under target, None when nothing was archived
+        """
+        if self._writer is None or self.failed:
+            self.discard()
+            return None
+
+        try:
+            with metrics.span('archive'):
+                self._writer.close()
+                self._writer = None
+
+                if self.target.startswith('s3://'):
+                    bucket, _, prefix = self.target[len('s3://'):].partition('/')
+                    key = '/'.join(part for part in (prefix.strip('/'), self.path) if part)
+                    cold_start.get_client('s3').upload_file(self._tmp_path, bucket, key)
+                else:
+                    dest = os.path.join(self.target, self.path)
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    shutil.move(self._tmp_path, dest)
+
+            metrics.count('archived_rows', self.rows)
+            return self.path
+
+        except Exception as e:
+            self.fail(e)
+            return None
+
+        finally:
+            self.discard()
+
+    def discard(self):
+        """ Drops unpublished file, when object failed to load """
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+            self._writer = None
+
+        if self._tmp_path and os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+        self._tmp_path = None
+
+    def fail(self, error):
+        self.failed = True
+        metrics.count('archive_failures')
+        print('FAIL: Archive of {} is skipped, ingest goes on. {}: {}'.format(self.path, type(error).__name__, error))
+        self.discard()
@@ -0,0 +1,76 @@
+""" Lazy loading of heavy dependencies and clients, with import/init time of cold starts """
+import functools
+import importlib
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+
+# Container start, taken when handler module first imports this module
+_started = perf_counter()
+
+# Seconds spent per imported module and created client, printed once after invocation they happened in
+init_timings = {}
+_reported = set()
+
+_modules = {}
+_clients = {}
+_lock = threading.Lock()
+
+
+@contextmanager
+def timed(name):
+    """ Records time spent in block under name """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        init_timings[name] = init_timings.get(name, 0) + perf_counter() - start
+
+
+def load_module(name):
+    """ Imports module on first use, later calls return it from cache
+        Args: name(dotted module name, e.g. 'xhtml2pdf.pisa')
+        Returns: module
+    """
+    module = _modules.get(name)
+    if module is None:
+        with timed('import ' + name):
+            module = importlib.import_module(name)
+        _modules[name] = module
+
+    return module
+
+
+def get_client(service):
+    """ Returns boto3 client of service, created on first use and reused while the container stays warm """
+    client = _clients.get(service)
+    if client is None:
+        # Default boto3 session is not safe for concurrent client creation from download threads
+        with _lock:
+            client = _clients.get(service)
+            if client is None:
+                boto3 = load_module('boto3')
+                with timed('client ' + service):
+                    client = boto3.client(service)
+                _clients[service] = client
+
+    return client
+
+
+def report_init(handler):
+    """ Decorator of lambda handler, prints module init time on cold start and every lazy import/client creation """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if 'init' not in init_timings:
+            init_timings['init'] = perf_counter() - _started
+
+        try:
+            return handler(event, context)
+        finally:
+            for name, seconds in init_timings.items():
+                if name not in _reported:
+                    print('INFO: Init {} took {:.3f}s'.format(name, seconds))
+                    _reported.add(name)
+
+    return wrapper
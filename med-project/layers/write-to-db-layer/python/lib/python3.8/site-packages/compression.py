@@ -0,0 +1,84 @@
+""" Compressed instrument uploads (.gz, .zst, .zip), decompressed as stream into ingest parsers """
+import contextlib
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+
+import cold_start
+
+
+COMPRESSED_EXTENSIONS = ('.gz', '.zst', '.zip')
+STREAM_BUFFER_BYTES = 1024 * 1024
+
+# Zip central directory is at the end, so S3 bodies of zip uploads are spooled first: in memory up to this size, /tmp above
+ZIP_SPOOL_BYTES = 64 * 1024 * 1024
+
+
+def get_content_name(name):
+    """ File name of uploaded object without .gz/.zst extension, e.g. a/results.txt.gz -> results.txt
+        Zip archives keep their name, name of file inside is known once archive is opened
+        Args: name(object key or file path)
+        Returns: file name
+    """
+    file_name = name.split('/')[-1]
+    root, extension = os.path.splitext(file_name)
+
+    if extension.lower() in ('.gz', '.zst'):
+        return root
+    return file_name
+
+
+def is_compressed(name):
+    return os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+@contextlib.contextmanager
+def open_decompressed(source, name):
+    """ Wraps binary stream of uploaded object into decompressing stream, read once from start
+        Decompressing streams, zip archive and its spooled copy are closed on exit, source is left to caller
+        Args: source(binary file or S3 streaming body), name(object key or file path, extension tells compression)
+        Returns: context manager of (content name, binary stream), uncompressed source is given as it is
+    """
+    extension = os.path.splitext(name)[1].lower()
+
+    with contextlib.ExitStack() as stack:
+        if extension == '.gz':
+            yield get_content_name(name), stack.enter_context(gzip.GzipFile(fileobj=source, mode='rb'))
+
+        elif extension == '.zst':
+            # Not in standard library, installed into layer next to pymysql
+            zstandard = cold_start.load_module('zstandard')
+            reader = zstandard.ZstdDecompressor().stream_reader(source, read_size=STREAM_BUFFER_BYTES,
+                                                                read_across_frames=True, closefd=False)
+            yield get_content_name(name), stack.enter_context(io.BufferedReader(reader, STREAM_BUFFER_BYTES))
+
+        elif extension == '.zip':
+            yield open_zip_member(source, stack)
+
+        else:
+            yield get_content_name(name), source
+
+
+def open_zip_member(source, stack):
+    """ Opens the single file of zip upload
+        Args: source(binary file, S3 body is spooled first), stack(ExitStack closing archive and spooled copy)
+        Returns: (file name inside archive, binary stream)
+    """
+    seekable = getattr(source, 'seekable', None)
+    if seekable is None or not seekable():
+        spooled = stack.enter_context(tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_BYTES))
+        shutil.copyfileobj(source, spooled, STREAM_BUFFER_BYTES)
+        spooled.seek(0)
+        source = spooled
+
+    archive = stack.enter_context(zipfile.ZipFile(source))
+
+    # Archives made on macOS carry resource forks next to the file
+    members = [info for info in archive.infolist() if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+    if len(members) != 1:
+        raise ValueError('FAIL: Zip upload must hold exactly one file, found {}!'.format(len(members)))
+
+    return members[0].filename.split('/')[-1], stack.enter_context(archive.open(members[0]))
@@ -1,4 +1,283 @@
 """ Database common operations """
+import hashlib
+import math
+import queue
+import re
+import threading
+from datetime import date
+from time import perf_counter
+
+import cold_start
+import metrics
+
+# Every invocation connects first, so it is loaded at init, timed with other cold start work
+pymysql = cold_start.load_module('pymysql')
+MySQLError = pymysql.MySQLError
+
+
+# Kept at module level so warm Lambda containers reuse them across invocations, connections per host
+_connections = {}
+_applied_versions = set()
+# Table-copy migrations this container found tables with rows for, left to admin invocation
+_deferred_versions = set()
+
+_max_allowed_packet = None
+_partitions_maintained_on = None
+
+# Number texts known to match REPR_NUMBERS. Instrument values repeat across records, set lookup is cheaper than matching
+_repr_numbers = set()
+
+# Share of max_allowed_packet one multi-row INSERT may fill, rest is left for escaping
+PACKET_FILL_RATIO = 0.75
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+# Parsed batches waiting for pipelined writer, parser blocks when writer is this far behind.
+# Pipelined batches are smaller, so the first write starts early and the rest overlaps with parsing
+PIPELINE_QUEUE_BATCHES = 2
+PIPELINE_BATCH_BYTES = 1024 * 1024
+
+# Claims last until claiming invocation times out, this long for claims made without Lambda context (Lambda timeout limit)
+MAX_LEASE_SECONDS = 900
+
+# Invocations wait this long for other container applying migrations, then fail instead of running against older schema
+MIGRATION_LOCK_SECONDS = 60
+NO_SUCH_TABLE_ERROR = 1146
+
+# Partition DDL waits this long for metadata lock held by open ingest transactions, maintenance is retried next invocation
+PARTITION_LOCK_WAIT_SECONDS = 2
+LOCK_WAIT_TIMEOUT_ERROR = 1205
+
+# Text MySQL converts to DOUBLE. Raw text columns keep instrument output as sent, typed columns are NULL where it is
+# no number (N/A, Blank, >1000)
+NUMBER_PATTERN = '^[-+]?[0-9]*[.]?[0-9]+([eE][-+]?[0-9]+)?$'
+
+# Numbers written as repr of their value (12.5, 12.0, 0.00001), report writes them out as sent from typed column.
+# With 15 digits at most every such text reads back as itself. Raw text is kept for the rest (12.50, 100, 1e3)
+REPR_NUMBER_PATTERN = '-?(?:0|[1-9][0-9]{0,7})[.](?:[0-9]{0,6}[1-9]|0)'
+REPR_NUMBERS = re.compile('{0}(?: {0})*'.format(REPR_NUMBER_PATTERN))
+REPR_NUMBERS_CACHED = 50000
+
+SCIEX_VALUE_COLUMNS = (('actual_concentration', 150), ('calculated_concentration', 30))
+OLYMPUS_VALUE_COLUMNS = ('amphetamine', 'barbiturates', 'benzodiazepine', 'cocaine', 'methadone',
+                         'opiates', 'oxycodone', 'phencyclidine_pcp', 'thc_cooh', 'ecstacy_mdma')
+
+# Result tables partitioned by month of ingested_at, expired months are dropped as whole partitions.
+# Partitions are created this many months ahead, so inserts never land in catch-all pmax
+PARTITIONED_TABLES = ('result_machine_sciex', 'result_machine_olympus')
+PARTITION_MONTHS_AHEAD = 3
+
+# Replication status of read replica, MySQL 8.0.22 renamed SLAVE statement and column. Column is NULL while stopped
+REPLICA_STATUS_STATEMENTS = (('SHOW REPLICA STATUS;', 'Seconds_Behind_Source'), ('SHOW SLAVE STATUS;', 'Seconds_Behind_Master'))
+AURORA_REPLICA_LAG_SQL = """SELECT replica_lag_in_milliseconds / 1000 AS lag FROM information_schema.replica_host_status
+                            WHERE server_id = @@aurora_server_id;"""
+
+# Replication status needs REPLICATION CLIENT privilege, server answers with this without it
+SPECIFIC_ACCESS_DENIED_ERROR = 1227
+
+# Server answers with these when LOAD DATA LOCAL INFILE is disabled
+LOCAL_INFILE_DISABLED_ERRORS = (1148, 2068, 3948)
+
+
+def get_connection(host, user, password, db_name, local_infile=False):
+    """ Returns cached connection of host, pinging it and reconnecting when it went away
+        Args: host, user, password, db_name, local_infile(allow LOAD DATA LOCAL INFILE)
+        Returns: DB connection
+    """
+    connection = _connections.get(host)
+
+    if connection is not None:
+        try:
+            connection.ping(reconnect=True)
+            # Drops whatever a previously failed invocation left uncommitted
+            connection.rollback()
+            return connection
+        except pymysql.MySQLError:
+            print('INFO: Cached connection is broken, reconnecting.')
+            del _connections[host]
+
+    connection = pymysql.connect(host=host, user=user,
+                                 passwd=password, db=db_name,
+                                 connect_timeout=5, charset='utf8mb4',
+                                 cursorclass=pymysql.cursors.DictCursor,
+                                 local_infile=local_infile)
+    _connections[host] = connection
+    return connection
+
+
+def get_reader_connection(host, user, password, db_name, max_lag_seconds):
+    """ Returns connection of read replica when it is fresh enough, caller reads from writer otherwise
+        Args: host(reader endpoint), user, password, db_name, max_lag_seconds(staleness guard)
+        Returns: DB connection, None when replica is unreachable, stopped or further behind than max_lag_seconds
+    """
+    try:
+        connection = get_connection(host, user, password, db_name)
+        lag = get_replica_lag(connection)
+
+    except pymysql.MySQLError as e:
+        print('INFO: Reader is not available, reading from writer. {}'.format(e))
+        return None
+
+    if lag is None or lag > max_lag_seconds:
+        print('INFO: Reader is {} seconds behind, reading from writer.'.format('unknown' if lag is None else lag))
+        return None
+
+    metrics.add_duration('replica_lag', lag)
+    return connection
+
+
+def get_replica_lag(conn):
+    """ Seconds replica is behind its source
+        Args: conn(DB connection to replica)
+        Returns: seconds, 0 for server that is no replica,
+                 None when replication is stopped or lag is unknown without REPLICATION CLIENT privilege
+    """
+    status_denied = False
+
+    with conn.cursor() as cursor:
+        for sql, column_name in REPLICA_STATUS_STATEMENTS:
+            try:
+                cursor.execute(sql)
+            except pymysql.err.ProgrammingError:
+                # Older servers know only SLAVE statement
+                continue
+            except pymysql.err.OperationalError as e:
+                # Both statements need the privilege, Aurora lag below does not
+                if e.args[0] != SPECIFIC_ACCESS_DENIED_ERROR:
+                    raise
+                status_denied = True
+                break
+
+            status = cursor.fetchone()
+            if status:
+                return status[column_name]
+            break
+
+        # Aurora replicas have no replication status, they report lag per instance
+        try:
+            cursor.execute(AURORA_REPLICA_LAG_SQL)
+        except pymysql.MySQLError:
+            if status_denied:
+                print('INFO: Replica lag is unknown, reader user needs REPLICATION CLIENT privilege.')
+                return None
+            return 0
+
+        row = cursor.fetchone()
+        return float(row['lag']) if row and row['lag'] is not None else 0
+
+
+def migrate(conn, db_name, offline=False, table_names=()):
+    """ Brings schema to latest version in MIGRATIONS, reading applied versions until container saw every one applied.
+        Table-copy migrations are applied inline only while their tables are empty, otherwise left to admin invocation
+        Args: conn(DB connection), db_name, offline(admin invocation, applies OFFLINE_MIGRATIONS to tables with rows too),
+              table_names(tables caller writes, fails while table-copy migration of any of them is pending)
+        Returns: schema version, latest applied migration
+    """
+    global _applied_versions
+
+    if len(_applied_versions) < len(MIGRATIONS):
+        _applied_versions = get_applied_versions(conn)
+        pending = [version for version, description, apply_migration in MIGRATIONS if version not in _applied_versions]
+
+        # Deferred migrations are checked again once per container only, admin invocation applies them
+        if offline or set(pending) - _deferred_versions:
+            apply_migrations(conn, db_name, offline)
+
+    for version in sorted(_deferred_versions - _applied_versions):
+        blocked = set(OFFLINE_MIGRATIONS[version]) & set(table_names)
+        if blocked:
+            raise RuntimeError('FAIL: Schema migration {} copies {} with rows, apply it with admin invocation '
+                               '{{"migrate": true}} first!'.format(version, ', '.join(sorted(blocked))))
+
+    return max(_applied_versions)
+
+
+def apply_migrations(conn, db_name, offline=False):
+    """ Applies pending migrations in order under schema migration lock, table-copy ones on tables with rows only offline
+        Args: conn(DB connection), db_name, offline(admin invocation)
+        Returns: None
+    """
+    global _applied_versions
+
+    with conn.cursor() as cursor:
+        # Only one container applies migrations, others wait and fail when it takes longer
+        cursor.execute('SELECT GET_LOCK(%s, %s) AS locked;', ('schema_migration_' + db_name, MIGRATION_LOCK_SECONDS))
+        if not cursor.fetchone()['locked']:
+            raise RuntimeError('FAIL: Schema migration is still applied by other invocation, schema is not up to date!')
+
+        try:
+            _applied_versions = get_applied_versions(conn)
+
+            for version, description, apply_migration in MIGRATIONS:
+                if version in _applied_versions:
+                    continue
+
+                # Migrations after it do not depend on it, they are applied anyway
+                if version in OFFLINE_MIGRATIONS and not offline and \
+                        not all(table_is_empty(conn, table_name) for table_name in OFFLINE_MIGRATIONS[version]):
+                    if version not in _deferred_versions:
+                        print('INFO: Schema migration {} ({}) copies tables with rows, left to admin invocation '
+                              '{{"migrate": true}}.'.format(version, description))
+                    _deferred_versions.add(version)
+                    continue
+
+                print('INFO: Applying schema migration {}: {}'.format(version, description))
+                apply_migration(conn, db_name)
+
+                cursor.execute('INSERT INTO schema_version (version, description) VALUES (%s, %s);',
+                               (version, description))
+                conn.commit()
+                _applied_versions.add(version)
+                print('SUCCESS: Schema migration {} applied.'.format(version))
+
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s);', ('schema_migration_' + db_name, ))
+
+
+def get_applied_versions(conn):
+    """ Reads applied schema migrations, creating schema_version table on first run
+        Args: conn(DB connection)
+        Returns: set of versions, empty for schema not managed yet
+    """
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute('SELECT version FROM schema_version;')
+            return {row['version'] for row in cursor.fetchall()}
+
+        except pymysql.err.ProgrammingError as e:
+            if e.args[0] != NO_SUCH_TABLE_ERROR:
+                raise
+
+        cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                          version int NOT NULL,description varchar(200),
+                          applied_at datetime DEFAULT CURRENT_TIMESTAMP,PRIMARY KEY (version));""")
+        conn.commit()
+        return set()
+
+
+def index_exists(conn, db_name, table_name, column_name):
+    """ Checks if any index of table starts with column, foreign key indexes included
+        Args: conn(DB connection), db_name, table_name, column_name
+        Returns: Bool
+    """
+    sql = """SELECT index_name FROM information_schema.statistics
+             WHERE table_schema=%s AND table_name=%s AND column_name=%s AND seq_in_index=1;"""
+    with conn.cursor() as cursor:
+        result = cursor.execute(sql, (db_name, table_name, column_name))
+        return True if result else False
+
+
+def add_index(conn, db_name, table_name, column_name):
+    """ Adds secondary index on column unless one is already there
+        Args: conn(DB connection), db_name, table_name, column_name
+        Returns: None
+    """
+    if index_exists(conn, db_name, table_name, column_name):
+        return
+
+    sql = 'ALTER TABLE {table_name} ADD INDEX idx_{table_name}_{column_name} ({column_name});'.format(
+        table_name=table_name, column_name=column_name)
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
 
 
 def table_exists(conn, db_name, table_name):
@@ -12,6 +291,411 @@ def table_exists(conn, db_name, table_name):
         return True if result else False
 
 
+def table_is_empty(conn, table_name):
+    """ Checks if table has no rows, without counting them
+        Args: conn(DB connection), table_name
+        Returns: Bool
+    """
+    with conn.cursor() as cursor:
+        return not cursor.execute('SELECT 1 FROM {} LIMIT 1;'.format(table_name))
+
+
+def column_exists(conn, db_name, table_name, column_name):
+    """ Checks if table has column
+        Args: conn(DB connection), db_name, table_name, column_name
+        Returns: Bool
+    """
+    sql = """SELECT column_name FROM information_schema.columns
+             WHERE table_schema=%s AND table_name=%s AND column_name=%s;"""
+    with conn.cursor() as cursor:
+        result = cursor.execute(sql, (db_name, table_name, column_name))
+        return True if result else False
+
+
+def parse_number(text):
+    """ Converts instrument value once at ingest for typed column and its raw text column.
+        Raw text is kept only where report would not give it back from number (N/A, 12.50, 100, 1e3)
+        Args: text
+        Returns: (float, None) for numbers matching REPR_NUMBERS, (float, text) for other numbers, (None, text) for anything else
+    """
+    try:
+        value = float(text)
+    except (TypeError, ValueError):
+        return None, text
+
+    # float() takes nan and inf too, DOUBLE columns do not
+    if not math.isfinite(value):
+        return None, text
+
+    return value, None if REPR_NUMBERS.fullmatch(text) else text
+
+
+def is_repr_numbers(texts):
+    """ Checks that every number text matches REPR_NUMBERS, so report gives values back from typed columns
+        Args: texts(list of number texts)
+        Returns: Bool
+    """
+    if _repr_numbers.issuperset(texts):
+        return True
+
+    if not REPR_NUMBERS.fullmatch(' '.join(texts)):
+        return False
+
+    if len(_repr_numbers) < REPR_NUMBERS_CACHED:
+        _repr_numbers.update(texts)
+    return True
+
+
+def get_max_allowed_packet(conn):
+    """ Reads server max_allowed_packet once per container
+        Args: conn(DB connection)
+        Returns: max_allowed_packet in bytes
+    """
+    global _max_allowed_packet
+
+    if _max_allowed_packet is None:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT @@max_allowed_packet AS max_allowed_packet;')
+            _max_allowed_packet = int(cursor.fetchone()['max_allowed_packet'])
+
+    return _max_allowed_packet
+
+
+def get_batch_bytes(conn):
+    """ Byte budget of one multi-row INSERT
+        Args: conn(DB connection)
+        Returns: bytes
+    """
+    return min(int(get_max_allowed_packet(conn) * PACKET_FILL_RATIO), MAX_BATCH_BYTES)
+
+
+def estimate_row_bytes(row):
+    """ Estimates encoded size of row inside INSERT ... VALUES
+        Args: row(tuple)
+        Returns: bytes
+    """
+    # Quotes and comma around every field, parentheses and comma around row
+    return sum(4 if field is None else len(str(field).encode('utf-8')) + 3 for field in row) + 3
+
+
+def iter_sized_batches(rows, max_bytes):
+    """ Groups rows so each group fits into one multi-row INSERT
+        Args: rows(iterable of tuples), max_bytes
+        Yield : list of rows, estimated size max_bytes or less
+    """
+    batch = []
+    batch_bytes = 0
+
+    for row in rows:
+        row_bytes = estimate_row_bytes(row)
+
+        if batch and batch_bytes + row_bytes > max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append(row)
+        batch_bytes += row_bytes
+
+    if batch:
+        yield batch
+
+
+def write_batch(conn, cursor, sql, batch, commit):
+    """ Inserts one sized batch with single multi-row INSERT, commits it when asked and prints its rows/sec
+        Args: conn(DB connection), cursor, sql(INSERT ... VALUES (%s, ...)), batch(list of tuples), commit
+        Returns: None
+    """
+    start = perf_counter()
+    with metrics.span('insert'):
+        cursor.executemany(sql, batch)
+    if commit:
+        with metrics.span('commit'):
+            conn.commit()
+    elapsed = perf_counter() - start
+
+    metrics.count('batches')
+    print('SUCCESS: {} {} rows in {:.3f}s ({:.0f} rows/sec)'.format(
+        'Committed' if commit else 'Inserted', len(batch), elapsed, len(batch) / elapsed if elapsed else 0))
+
+
+def insert_batches(conn, sql, rows, max_bytes=None, on_batch=None, commit=True):
+    """ Inserts rows with one multi-row INSERT per sized batch
+        Args: conn(DB connection), sql(INSERT ... VALUES (%s, ...)), rows(iterable of tuples),
+              max_bytes(batch budget, defaults to one based on max_allowed_packet), on_batch(called with every written batch),
+              commit(commit per batch, False leaves all rows to one transaction caller commits)
+        Returns: number of inserted rows
+    """
+    if max_bytes is None:
+        max_bytes = get_batch_bytes(conn)
+
+    inserted = 0
+    with conn.cursor() as cursor:
+        # Lets pymysql send whole batch as single statement, escaping overhead included
+        cursor.max_stmt_length = get_max_allowed_packet(conn) - 1024
+
+        for batch in iter_sized_batches(rows, max_bytes):
+            write_batch(conn, cursor, sql, batch, commit)
+
+            inserted += len(batch)
+            if on_batch is not None:
+                on_batch(batch)
+
+    return inserted
+
+
+def insert_batches_pipelined(conn, sql, rows, max_bytes=None, on_batch=None, commit=True, queue_batches=PIPELINE_QUEUE_BATCHES):
+    """ Same as insert_batches, but rows are parsed and batched on producer thread while earlier batches are written,
+        so parsing overlaps with DB round trips. Parser error is raised here, writer error stops parser
+        Args: conn(DB connection), sql(INSERT ... VALUES (%s, ...)), rows(iterable of tuples, parsed lazily),
+              max_bytes(batch budget, capped at PIPELINE_BATCH_BYTES), on_batch(called with every written batch),
+              commit(commit per batch, False leaves all rows to one transaction caller commits),
+              queue_batches(batches parsed ahead of writer)
+        Returns: number of inserted rows
+    """
+    max_bytes = min(max_bytes or get_batch_bytes(conn), PIPELINE_BATCH_BYTES)
+
+    batches = queue.Queue(maxsize=queue_batches)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        """ Blocks while queue is full, gives up when writer stopped """
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        start = perf_counter()
+        waited = 0
+        try:
+            for batch in iter_sized_batches(rows, max_bytes):
+                put_start = perf_counter()
+                if not put(batch):
+                    return
+                waited += perf_counter() - put_start
+            item = done
+
+        except BaseException as e:
+            item = e
+
+        finally:
+            # Time blocked on full queue is backpressure, not parsing
+            metrics.add_duration('parse', perf_counter() - start - waited)
+
+        put(item)
+
+    producer = threading.Thread(target=produce, name='ingest-parser', daemon=True)
+    producer.start()
+
+    inserted = 0
+    try:
+        with conn.cursor() as cursor:
+            cursor.max_stmt_length = get_max_allowed_packet(conn) - 1024
+
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+
+                write_batch(conn, cursor, sql, batch, commit)
+
+                inserted += len(batch)
+                if on_batch is not None:
+                    on_batch(batch)
+
+    finally:
+        stopped.set()
+        producer.join()
+        # Releases file or S3 body of parser that was stopped halfway
+        if hasattr(rows, 'close'):
+            rows.close()
+
+    return inserted
+
+
+def load_data_local_infile(conn, table_name, columns, file_path):
+    """ Bulk loads tab separated file into table, caller commits
+        Args: conn(DB connection), table_name, columns, file_path(TSV with MySQL escaping)
+        Returns: number of loaded rows
+    """
+    sql = """LOAD DATA LOCAL INFILE %s INTO TABLE {table_name} CHARACTER SET utf8mb4
+             FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({columns});""".format(
+        table_name=table_name, columns=', '.join(columns))
+
+    with conn.cursor() as cursor:
+        return cursor.execute(sql, (file_path, ))
+
+
+def get_lease_seconds(context):
+    """ Claims of invocation last until it times out
+        Args: context(Lambda context, None in local runs)
+        Returns: seconds
+    """
+    if context is None:
+        return MAX_LEASE_SECONDS
+    return int(math.ceil(context.get_remaining_time_in_millis() / 1000))
+
+
+def get_ingest_lock_name(bucket, key, etag):
+    """ Named lock of uploaded object, lock names are limited to 64 characters """
+    return 'ingest_' + hashlib.sha1('/'.join((bucket, key, etag)).encode('utf-8')).hexdigest()
+
+
+def claim_ingest(conn, bucket, key, etag, lease_seconds):
+    """ Atomically claims uploaded object in ingest_manifest. Claim is held as named lock of connection,
+        so claim of invocation that crashed or timed out is free as soon as its connection is gone.
+        Lease covers connections left open after their invocation timed out
+        Args: conn(DB connection), bucket, key, etag, lease_seconds(remaining time of invocation)
+        Returns: 'claimed', 'loaded' when object is already loaded, 'processing' when other invocation is loading it
+    """
+    sql_status = """SELECT status, lease_expires_at < NOW() AS expired FROM ingest_manifest
+                    WHERE bucket=%s AND object_key=%s AND etag=%s;"""
+
+    sql_claim = """INSERT INTO ingest_manifest (bucket, object_key, etag, status, lease_expires_at)
+                   VALUES (%s, %s, %s, 'processing', NOW() + INTERVAL %s SECOND)
+                   ON DUPLICATE KEY UPDATE status='processing', row_count=NULL, lease_expires_at=VALUES(lease_expires_at);"""
+
+    # Only one invocation takes over claim that failed or whose lease ran out, while lock is still held by open connection
+    sql_take_over = """UPDATE ingest_manifest SET status='processing', row_count=NULL, lease_expires_at=NOW() + INTERVAL %s SECOND
+                       WHERE bucket=%s AND object_key=%s AND etag=%s AND (status='failed' OR (status='processing' AND lease_expires_at < NOW()));"""
+
+    lock_name = get_ingest_lock_name(bucket, key, etag)
+
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT GET_LOCK(%s, 0) AS locked;', (lock_name, ))
+        locked = cursor.fetchone()['locked'] == 1
+
+        try:
+            cursor.execute(sql_status, (bucket, key, etag))
+            manifest = cursor.fetchone()
+
+            # Every branch commits, so next claim does not read this snapshot
+            if manifest and manifest['status'] == 'loaded':
+                conn.commit()
+                if locked:
+                    cursor.execute('SELECT RELEASE_LOCK(%s);', (lock_name, ))
+                return 'loaded'
+
+            if locked:
+                cursor.execute(sql_claim, (bucket, key, etag, lease_seconds))
+                conn.commit()
+                return 'claimed'
+
+            if manifest and (manifest['status'] == 'failed' or manifest['expired']) and \
+                    cursor.execute(sql_take_over, (lease_seconds, bucket, key, etag)) == 1:
+                conn.commit()
+                print('INFO: Claim of failed or timed out invocation is taken over: {} ({})'.format(key, etag))
+                return 'claimed'
+
+            conn.commit()
+            return 'processing'
+
+        except Exception:
+            # Warm connection must not keep lock of claim that did not go through
+            conn.rollback()
+            if locked:
+                cursor.execute('SELECT RELEASE_LOCK(%s);', (lock_name, ))
+            raise
+
+
+def claim_objects(conn, objects, lease_seconds=MAX_LEASE_SECONDS):
+    """ Claims every object, skipping ones already loaded or being loaded by other invocation.
+        Object delivered twice in one event is claimed once, named locks are re-entrant within connection.
+        When a claim fails, objects claimed before it are released as failed
+        Args: conn(DB connection), objects(list of (bucket, key, etag)), lease_seconds(remaining time of invocation)
+        Returns: list of claimed objects
+    """
+    claimed = []
+    try:
+        for bucket, key, etag in objects:
+            if (bucket, key, etag) in claimed:
+                metrics.count('skipped_duplicate')
+                print('INFO: Object is repeated in event, skipping: {} ({})'.format(key, etag))
+                continue
+
+            status = claim_ingest(conn, bucket, key, etag, lease_seconds)
+
+            if status == 'claimed':
+                claimed.append((bucket, key, etag))
+            elif status == 'loaded':
+                metrics.count('skipped_loaded')
+                print('INFO: Object is already loaded, skipping: {} ({})'.format(key, etag))
+            else:
+                metrics.count('skipped_in_progress')
+                print('INFO: Object is being loaded by other invocation, skipping: {} ({})'.format(key, etag))
+
+    except Exception:
+        if claimed:
+            fail_ingest(conn, claimed)
+        raise
+
+    return claimed
+
+
+def finish_ingest(conn, bucket, key, etag, row_count):
+    """ Marks claimed object as loaded and commits it in one transaction with its rows, then releases claim
+        Args: conn(DB connection), bucket, key, etag, row_count
+        Returns: None
+    """
+    sql = """UPDATE ingest_manifest SET status='loaded', row_count=%s
+             WHERE bucket=%s AND object_key=%s AND etag=%s;"""
+
+    with conn.cursor() as cursor:
+        cursor.execute(sql, (row_count, bucket, key, etag))
+        conn.commit()
+        cursor.execute('SELECT RELEASE_LOCK(%s);', (get_ingest_lock_name(bucket, key, etag), ))
+
+
+def fail_ingest(conn, objects):
+    """ Rolls back rows of object being loaded, marks claimed objects as failed, so redelivery loads them again
+        Args: conn(DB connection), objects(list of (bucket, key, etag))
+        Returns: None
+    """
+    sql = """UPDATE ingest_manifest SET status='failed'
+             WHERE bucket=%s AND object_key=%s AND etag=%s AND status='processing';"""
+
+    conn.rollback()
+    with conn.cursor() as cursor:
+        cursor.executemany(sql, objects)
+        conn.commit()
+
+        for bucket, key, etag in objects:
+            cursor.execute('SELECT RELEASE_LOCK(%s);', (get_ingest_lock_name(bucket, key, etag), ))
+
+
+def create_ingest_manifest_table(conn):
+    """ Creates ingest_manifest table, one row per loaded S3 object version
+        Args: conn(DB connection)
+        Return: None
+    """
+    sql = """CREATE TABLE IF NOT EXISTS ingest_manifest (
+             id int NOT NULL AUTO_INCREMENT,bucket varchar(63),object_key varchar(512),etag varchar(64),
+             status varchar(20),row_count int,created_at datetime DEFAULT CURRENT_TIMESTAMP,
+             updated_at datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+             PRIMARY KEY (id), UNIQUE KEY ingest_manifest_object (bucket, object_key, etag));"""
+
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+        conn.commit()
+
+
+def add_ingest_claim_leases(conn, db_name):
+    """ Migration 5, claims in ingest_manifest expire when claiming invocation times out
+        Args: conn(DB connection), db_name
+        Return: None
+    """
+    if not column_exists(conn, db_name, 'ingest_manifest', 'lease_expires_at'):
+        with conn.cursor() as cursor:
+            cursor.execute('ALTER TABLE ingest_manifest ADD COLUMN lease_expires_at datetime AFTER row_count;')
+
+
 def create_film_array_tables(conn):
     """ Creates film_array tables
         Args: conn(DB connection)
@@ -54,7 +738,7 @@ def create_sciex_table(conn):
         Return: None
     """
     # SQL query for creating sciex table
-    sql = """CREATE TABLE result_machine_sciex (
+    sql = """CREATE TABLE IF NOT EXISTS result_machine_sciex (
              id int NOT NULL AUTO_INCREMENT,sample_name varchar(200),component_name varchar(150),
              actual_concentration varchar(150),calculated_concentration varchar(30),PRIMARY KEY (id));"""
 
@@ -78,3 +762,214 @@ def create_olympus_table(conn):
     with conn.cursor() as cursor:
         cursor.execute(sql)
         conn.commit()
+
+
+def create_result_tables(conn, db_name):
+    """ Migration 1, tables every function writes to
+        Args: conn(DB connection), db_name
+        Return: None
+    """
+    create_sciex_table(conn)
+    create_olympus_table(conn)
+    create_film_array_tables(conn)
+    create_ingest_manifest_table(conn)
+
+
+def add_report_lookup_indexes(conn, db_name):
+    """ Migration 2, indexes for columns cumulative report filters by
+        Args: conn(DB connection), db_name
+        Return: None
+    """
+    add_index(conn, db_name, 'result_machine_sciex', 'sample_name')
+    add_index(conn, db_name, 'result_machine_olympus', 'accession_number')
+    add_index(conn, db_name, 'result_machine_film_array', 'specimen_identifier')
+    add_index(conn, db_name, 'result_machine_film_array_group', 'test_id')
+    add_index(conn, db_name, 'result_machine_film_array_group_item', 'result_group_id')
+
+
+def add_typed_result_values(conn, db_name):
+    """ Migration 3, concentrations stored as DOUBLE instead of varchar. Text report could not write out from number
+        is copied to raw column first: per column in sciex, whole row of values in olympus. Text that is no number becomes NULL
+        Args: conn(DB connection), db_name
+        Return: None
+    """
+    # True where report writes out number of column as sent
+    formatted = 'IFNULL({0} REGEXP %s, FALSE)'
+    repr_number = '^{}$'.format(REPR_NUMBER_PATTERN)
+
+    with conn.cursor() as cursor:
+        for column_name, size in SCIEX_VALUE_COLUMNS:
+            if not column_exists(conn, db_name, 'result_machine_sciex', column_name + '_raw'):
+                cursor.execute('ALTER TABLE result_machine_sciex ADD COLUMN {0}_raw varchar({1}) AFTER {0};'.format(
+                    column_name, size))
+
+            # Columns are assigned left to right, so raw column gets value before it is cleared
+            cursor.execute('UPDATE result_machine_sciex SET {0}_raw = IF({1}, NULL, {0}), {0} = IF({0} REGEXP %s, {0}, NULL);'.format(
+                column_name, formatted.format(column_name)), (repr_number, NUMBER_PATTERN))
+
+        cursor.execute('ALTER TABLE result_machine_sciex {};'.format(
+            ', '.join('MODIFY {} double'.format(column_name) for column_name, size in SCIEX_VALUE_COLUMNS)))
+
+        if not column_exists(conn, db_name, 'result_machine_olympus', 'raw_values'):
+            cursor.execute('ALTER TABLE result_machine_olympus ADD COLUMN raw_values varchar(400);')
+
+        # Every value keeps its position, report splits raw_values into 10 values. Columns are assigned left to right,
+        # so raw_values gets values before they are cleared
+        cursor.execute('UPDATE result_machine_olympus SET raw_values = IF({formatted}, NULL, CONCAT({columns})), {clear};'.format(
+            formatted=' AND '.join(formatted.format(column_name) for column_name in OLYMPUS_VALUE_COLUMNS),
+            columns=", ' ', ".join('IFNULL({}, \'\')'.format(column_name) for column_name in OLYMPUS_VALUE_COLUMNS),
+            clear=', '.join('{0} = IF({0} REGEXP %s, {0}, NULL)'.format(column_name) for column_name in OLYMPUS_VALUE_COLUMNS)),
+            (repr_number, ) * len(OLYMPUS_VALUE_COLUMNS) + (NUMBER_PATTERN, ) * len(OLYMPUS_VALUE_COLUMNS))
+
+        cursor.execute('ALTER TABLE result_machine_olympus {};'.format(
+            ', '.join('MODIFY {} double'.format(column_name) for column_name in OLYMPUS_VALUE_COLUMNS)))
+        conn.commit()
+
+
+def add_months(month, months):
+    """ First day of month shifted by months
+        Args: month(date), months(may be negative)
+        Returns: date
+    """
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def get_month_partitions(conn, db_name, table_name):
+    """ Reads monthly partitions of table
+        Args: conn(DB connection), db_name, table_name
+        Returns: list of first days of partitioned months in order, pmax left out
+    """
+    sql = """SELECT partition_name FROM information_schema.partitions
+             WHERE table_schema=%s AND table_name=%s AND partition_name IS NOT NULL ORDER BY partition_ordinal_position;"""
+    with conn.cursor() as cursor:
+        cursor.execute(sql, (db_name, table_name))
+        names = [row['partition_name'] for row in cursor.fetchall()]
+
+    return [date(int(name[1:5]), int(name[5:7]), 1) for name in names if name != 'pmax']
+
+
+def get_partition_definition(month):
+    """ Partition p<yyyymm> of rows ingested in month and before, when no older partition holds them """
+    return "PARTITION p{:%Y%m} VALUES LESS THAN (TO_DAYS('{:%Y-%m-%d}'))".format(month, add_months(month, 1))
+
+
+def add_month_partitions(conn, db_name, table_name, until):
+    """ Splits months after last partition off pmax
+        Args: conn(DB connection), db_name, table_name, until(first day of last month to create)
+        Returns: number of created partitions
+    """
+    months = get_month_partitions(conn, db_name, table_name)
+    if not months:
+        print('INFO: {} is not partitioned yet, migration 4 is pending.'.format(table_name))
+        return 0
+
+    month = add_months(months[-1], 1)
+
+    definitions = []
+    while month <= until:
+        definitions.append(get_partition_definition(month))
+        month = add_months(month, 1)
+
+    if definitions:
+        sql = 'ALTER TABLE {} REORGANIZE PARTITION pmax INTO ({}, PARTITION pmax VALUES LESS THAN MAXVALUE);'.format(
+            table_name, ', '.join(definitions))
+        with conn.cursor() as cursor:
+            cursor.execute(sql)
+
+    return len(definitions)
+
+
+def drop_expired_partitions(conn, db_name, table_name, retention_months, today=None):
+    """ Drops whole partitions of months older than retention, no row by row delete
+        Args: conn(DB connection), db_name, table_name, retention_months(current month included), today
+        Returns: list of dropped partition names
+    """
+    cutoff = add_months(today or date.today(), 1 - retention_months)
+    months = get_month_partitions(conn, db_name, table_name)
+
+    # Newest partition stays even when expired, it takes rows up to next partition
+    expired = ['p{:%Y%m}'.format(month) for month in months[:-1] if month < cutoff]
+
+    if expired:
+        with conn.cursor() as cursor:
+            cursor.execute('ALTER TABLE {} DROP PARTITION {};'.format(table_name, ', '.join(expired)))
+        print('INFO: Dropped expired partitions of {}: {}'.format(table_name, ', '.join(expired)))
+
+    return expired
+
+
+def maintain_partitions(conn, db_name, retention_months=0):
+    """ Creates upcoming monthly partitions and drops expired ones, once a day per container
+        Args: conn(DB connection), db_name, retention_months(0 keeps every month)
+        Returns: None
+    """
+    global _partitions_maintained_on
+
+    today = date.today()
+    if _partitions_maintained_on == today:
+        return
+
+    with conn.cursor() as cursor:
+        # Container holding lock does it, others go on ingesting
+        cursor.execute('SELECT GET_LOCK(%s, 0) AS locked;', ('partition_maintenance_' + db_name, ))
+        if not cursor.fetchone()['locked']:
+            return
+
+        try:
+            # DDL waits for transactions open on table, statements queued behind it wait as long. Ingest goes on
+            # when it times out
+            cursor.execute('SET SESSION lock_wait_timeout = %s;', (PARTITION_LOCK_WAIT_SECONDS, ))
+
+            for table_name in PARTITIONED_TABLES:
+                add_month_partitions(conn, db_name, table_name, add_months(today, PARTITION_MONTHS_AHEAD))
+                if retention_months:
+                    drop_expired_partitions(conn, db_name, table_name, retention_months, today)
+
+        except pymysql.err.OperationalError as e:
+            if e.args[0] != LOCK_WAIT_TIMEOUT_ERROR:
+                raise
+            print('INFO: Partition maintenance is retried next invocation, tables are in use. {}'.format(e))
+            return
+
+        finally:
+            cursor.execute('SET SESSION lock_wait_timeout = DEFAULT;')
+            cursor.execute('SELECT RELEASE_LOCK(%s);', ('partition_maintenance_' + db_name, ))
+
+    _partitions_maintained_on = today
+
+
+def partition_result_tables(conn, db_name):
+    """ Migration 4, sciex and olympus rows record ingested_at and are range partitioned by its month.
+        Partitioning column must be part of every unique key, so primary key becomes (id, ingested_at).
+        Rows loaded before get migration time
+        Args: conn(DB connection), db_name
+        Return: None
+    """
+    this_month = add_months(date.today(), 0)
+    definitions = [get_partition_definition(add_months(this_month, months)) for months in range(PARTITION_MONTHS_AHEAD + 1)]
+
+    with conn.cursor() as cursor:
+        for table_name in PARTITIONED_TABLES:
+            if not column_exists(conn, db_name, table_name, 'ingested_at'):
+                cursor.execute("""ALTER TABLE {} ADD COLUMN ingested_at datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                                  DROP PRIMARY KEY, ADD PRIMARY KEY (id, ingested_at);""".format(table_name))
+
+            if not get_month_partitions(conn, db_name, table_name):
+                cursor.execute('ALTER TABLE {} PARTITION BY RANGE (TO_DAYS(ingested_at)) ({}, PARTITION pmax VALUES LESS THAN MAXVALUE);'.format(
+                    table_name, ', '.join(definitions)))
+
+
+# Schema migrations in order, new ones are appended with next version
+MIGRATIONS = (
+    (1, 'result tables', create_result_tables),
+    (2, 'report lookup indexes', add_report_lookup_indexes),
+    (3, 'typed result values', add_typed_result_values),
+    (4, 'monthly result partitions', partition_result_tables),
+    (5, 'ingest claim leases', add_ingest_claim_leases),
+)
+
+# Table-copy ALTERs and tables they copy, on large tables they take longer than ingest invocation may wait or even
+# Lambda timeout. Applied inline while tables are empty, by admin invocation otherwise. Ingest writing one of the
+# tables fails fast while its migration is pending, other ingest goes on
+OFFLINE_MIGRATIONS = {3: ('result_machine_sciex', 'result_machine_olympus'), 4: PARTITIONED_TABLES}
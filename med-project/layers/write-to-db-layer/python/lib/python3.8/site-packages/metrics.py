@@ -0,0 +1,97 @@
+""" Timing spans and counters of one invocation, written as single CloudWatch embedded metric format line """
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from time import perf_counter
+
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'MedProject')
+
+# Units of counters, every other counter is Count
+COUNTER_UNITS = {'bytes': 'Bytes', 'pdf_bytes': 'Bytes'}
+
+_lock = threading.Lock()
+_durations = {}
+_counters = {}
+_properties = {}
+
+
+@contextmanager
+def span(stage):
+    """ Adds time spent in block to stage, stages running on several threads are summed """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        add_duration(stage, perf_counter() - start)
+
+
+def add_duration(stage, seconds):
+    with _lock:
+        _durations[stage] = _durations.get(stage, 0) + seconds
+
+
+def count(name, value=1):
+    """ Adds value to counter of invocation, e.g. rows, bytes, objects """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_property(name, value):
+    """ Logged with metrics for searching in CloudWatch Logs Insights, not a metric """
+    _properties[name] = value
+
+
+def get_metrics_line(function_name, status):
+    """ Embedded metric format JSON of invocation so far
+        Args: function_name(dimension), status(SUCCESS or FAIL)
+        Returns: JSON line
+    """
+    metrics = [{'Name': stage, 'Unit': 'Milliseconds'} for stage in _durations]
+    metrics += [{'Name': name, 'Unit': COUNTER_UNITS.get(name, 'Count')} for name in _counters]
+
+    line = dict(_properties)
+    line.update({stage: round(seconds * 1000, 3) for stage, seconds in _durations.items()})
+    line.update(_counters)
+    line.update({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{'Namespace': NAMESPACE, 'Dimensions': [['FunctionName']], 'Metrics': metrics}]
+        },
+        'FunctionName': function_name,
+        'status': status
+    })
+
+    return json.dumps(line, default=str)
+
+
+def instrumented(function_name):
+    """ Decorator of lambda handler, times whole invocation and prints its metrics line at the end """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            with _lock:
+                _durations.clear()
+                _counters.clear()
+            _properties.clear()
+
+            status = 'FAIL'
+            try:
+                with span('total'):
+                    result = handler(event, context)
+                status = 'SUCCESS'
+                return result
+
+            except BaseException as e:
+                set_property('error', '{}: {}'.format(type(e).__name__, e))
+                raise
+
+            finally:
+                print(get_metrics_line(function_name, status))
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,41 @@
+""" S3 event common operations """
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+
+import cold_start
+
+
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 4))
+
+
+def get_event_objects(event):
+    """ Collects every uploaded object of S3 event, S3 client is created only for record without ETag
+        Args: event(S3 event)
+        Returns: list of (bucket, key, etag) tuples
+    """
+    objects = []
+    for record in event['Records']:
+        source_bucket = record['s3']['bucket']['name']
+        # Keys in S3 notifications are url encoded
+        key = unquote_plus(record['s3']['object']['key'])
+
+        etag = record['s3']['object'].get('eTag')
+        if not etag:
+            etag = cold_start.get_client('s3').head_object(Bucket=source_bucket, Key=key)['ETag']
+
+        objects.append((source_bucket, key, etag.strip('"')))
+
+    return objects
+
+
+def map_objects(load_object, objects, max_workers=MAX_WORKERS):
+    """ Runs load_object for each object on bounded thread pool
+        Args: load_object(function taking bucket and key), objects(list of (bucket, key, etag)), max_workers
+        Yield : (bucket, key, etag, result) in event order, while later objects are still loading
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(load_object, source_bucket, key) for source_bucket, key, etag in objects]
+
+        for (source_bucket, key, etag), future in zip(objects, futures):
+            yield source_bucket, key, etag, future.result()
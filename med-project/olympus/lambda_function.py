@@ -1,130 +1,256 @@
+import io
+import math
 import sys
 import os
+import shutil
 import tempfile
 
-import boto3
-import pymysql
-
+import archive
+import cold_start
+import compression
 import database_helper as db_helper
+import metrics
+import s3_helper
 
 DB_HOST = os.environ['DB_HOST']
 DB_USERNAME = os.environ['DB_USERNAME']
 DB_PASSWORD = os.environ['DB_PASSWORD']
 DB_NAME = os.environ['DB_NAME']
 
-s3 = boto3.client('s3')
+# Months of sciex and olympus results kept, older monthly partitions are dropped. 0 keeps everything
+RETENTION_MONTHS = int(os.environ.get('RETENTION_MONTHS', 0))
+
+# Rejected lines of every object are written here as <key>.rejects.txt, logged only when not set
+REJECTS_BUCKET = os.environ.get('REJECTS_BUCKET')
+
+# Pipelined mode parses rows on producer thread while earlier batches are written
+PIPELINE = os.environ.get('PIPELINE', 'false').lower() == 'true'
+
+# Column types of Parquet archive, written when ARCHIVE_TARGET is set
+OLYMPUS_ARCHIVE_COLUMNS = (('accession_number', 'string'), ('specimen_type', 'string'), ('patient_name', 'string')) + \
+    tuple((column_name, 'double') for column_name in db_helper.OLYMPUS_VALUE_COLUMNS) + (('raw_values', 'string'), )
+
+# AU400 record: accession number with specimen type letter, patient name, '01', then value and flag of every test.
+# Record is split from line end, so digits and '01' inside patient name do not move the split
+OLYMPUS_TEST_COUNT = 10
 
 
+@cold_start.report_init
+@metrics.instrumented('olympus')
 def lambda_handler(event, context):
-    # Connection setup
+    # Connection setup, reused while the container stays warm
     try:
-        conn = pymysql.connect(DB_HOST, user=DB_USERNAME,
-                               passwd=DB_PASSWORD, db=DB_NAME,
-                               connect_timeout=5, charset='utf8mb4',
-                               cursorclass=pymysql.cursors.DictCursor)
+        with metrics.span('connect'):
+            conn = db_helper.get_connection(DB_HOST, DB_USERNAME, DB_PASSWORD, DB_NAME)
 
-    except pymysql.MySQLError as e:
+    except db_helper.MySQLError as e:
         print("ERROR: Unexpected error: Could not connect to MySQL instance.")
         print(e)
         sys.exit()
 
-    print("SUCCESS: Connection to RDS MySQL instance succeeded")
+    # Admin invocation {"migrate": true} applies every pending migration, table-copy ones included
+    if event.get('migrate'):
+        with metrics.span('migrate'):
+            return {'schema_version': db_helper.migrate(conn, DB_NAME, offline=True)}
+
+    # Getting event info, unsupported uploads fail before S3 client is created or anything is claimed
+    event_objects = s3_helper.get_event_objects(event)
+    for source_bucket, key, etag in event_objects:
+        check_file_type(key)
+
+    # Creating tables and indexes in case, schema is behind, then monthly partitions ahead and expired ones dropped
+    with metrics.span('migrate'):
+        db_helper.migrate(conn, DB_NAME, table_names=('result_machine_olympus', ))
+        db_helper.maintain_partitions(conn, DB_NAME, RETENTION_MONTHS)
+
+    # Objects loaded before are skipped
+    with metrics.span('claim'):
+        objects = db_helper.claim_objects(conn, event_objects, db_helper.get_lease_seconds(context))
+    metrics.count('objects', len(objects))
+    sql = """INSERT INTO result_machine_olympus 
+                  (accession_number, specimen_type, patient_name, amphetamine, 
+                  barbiturates, benzodiazepine, cocaine, methadone, 
+                  opiates, oxycodone, phencyclidine_pcp, thc_cooh, ecstacy_mdma, raw_values) 
+                  VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+
+    loaded = []
+    object_archive = None
+
+    # Downloads overlap on thread pool, files are parsed there too unless pipelined mode parses them while writing
+    load_object = download_s3_object if PIPELINE else load_s3_object
 
-    # Creating table in case, No table
-    if not db_helper.table_exists(conn, DB_NAME, 'olympus'):
-        print('INFO: No table, creating.')
-        db_helper.create_olympus_table(conn)
-        print('SUCCESS: Table created.')
+    try:
+        # Batches are sized by bytes against server max_allowed_packet, claims are released when it cannot be read
+        batch_bytes = db_helper.get_batch_bytes(conn)
+
+        for source_bucket, key, etag, data in s3_helper.map_objects(load_object, objects):
+            # Written batches are archived too when ARCHIVE_TARGET is set, archive is published once object is committed
+            object_archive = archive.open_archive('olympus', OLYMPUS_ARCHIVE_COLUMNS, key, etag)
+            on_batch = object_archive.write_batch if object_archive else None
+
+            # Rows of object are committed in one transaction together with manifest row
+            with metrics.span('write'):
+                if PIPELINE:
+                    row_count = pipelined_load(conn, sql, batch_bytes, source_bucket, key, *data, on_batch=on_batch)
+                else:
+                    row_count = db_helper.insert_batches(conn, sql, data, batch_bytes, on_batch, commit=False)
+
+                with metrics.span('commit'):
+                    db_helper.finish_ingest(conn, source_bucket, key, etag, row_count)
+
+            if object_archive:
+                object_archive.close()
+
+            metrics.count('rows', row_count)
+            loaded.append((source_bucket, key, etag))
+
+    except Exception:
+        if object_archive:
+            object_archive.discard()
+        db_helper.fail_ingest(conn, [obj for obj in objects if obj not in loaded])
+        raise
 
-    # Getting event info
-    source_bucket = event['Records'][0]['s3']['bucket']['name']
-    key = event['Records'][0]['s3']['object']['key']
-    print('SUCCESS : Object was uploaded: {}'.format(key))
 
-    # Temporary location for storing s3 object
-    with tempfile.TemporaryDirectory() as tmpdir:
-        file_name = key.split('/')[-1]
-        file_type = file_name.split('.')[-1]
+def load_s3_object(source_bucket, key):
+    """ Downloads and parses one uploaded object
+        Args: source_bucket, key
+        Returns: list of row tuples
+    """
+    tmpdir, download_path = download_s3_object(source_bucket, key)
 
-        if file_type.lower() != 'log':
-            print('FAIL: File type is not supported!')
-            raise TypeError('Not supported file!')
+    try:
+        rejects = []
+        with metrics.span('parse'):
+            rows = list(get_optimized_query_data(download_path, rejects))
+    finally:
+        shutil.rmtree(tmpdir)
 
-        download_path = os.path.join(tmpdir, file_name)
-        print('SUCCESS: TEMPDIR has been created')
+    check_rejects(source_bucket, key, rejects, len(rows))
+    return rows
 
-        s3.download_file(source_bucket, key, download_path)
-        print('SUCCESS: S3 Object has been downloaded')
 
-        # Getting data by set 10k rows or less
-        query_data_generator = get_optimized_query_data(download_path)
+def download_s3_object(source_bucket, key):
+    """ Downloads one uploaded object
+        Args: source_bucket, key
+        Returns: (tmpdir, download_path), caller removes tmpdir
+    """
+    file_name = key.split('/')[-1]
 
-        sql = """INSERT INTO olympus 
-                      (accession_number, specimen_type, patient_name, amphetamine, 
-                      barbiturates, benzodiazepine, cocaine, methadone, 
-                      opiates, oxycodone, phencyclidine_pcp, thc_cooh, ecstacy_mdma) 
-                      VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+    # Temporary location for storing s3 object
+    tmpdir = tempfile.mkdtemp()
+    download_path = os.path.join(tmpdir, file_name)
 
-        # MySQL cursor
-        with conn.cursor() as cursor:
+    try:
+        with metrics.span('download'):
+            cold_start.get_client('s3').download_file(source_bucket, key, download_path)
+        metrics.count('bytes', os.path.getsize(download_path))
 
-            for data_set in query_data_generator:
-                cursor.executemany(sql, data_set)
-                conn.commit()
-                print('SUCCESS: Committing...')
+    except Exception:
+        shutil.rmtree(tmpdir)
+        raise
 
-    print('SUCCESS: DONE')
+    return tmpdir, download_path
 
 
-def get_optimized_query_data(s3_file):
-    """
-        s3_file : File temp location to s3 file
-        Yield : Slice file lines by 10k or less
+def pipelined_load(conn, sql, batch_bytes, source_bucket, key, tmpdir, download_path, on_batch=None):
+    """ Parses downloaded file on producer thread while its batches are written
+        Args: conn(DB connection), sql(executemany INSERT), batch_bytes, source_bucket, key,
+              tmpdir(removed afterwards), download_path, on_batch(called with every written batch)
+        Returns: number of inserted rows, caller commits
     """
-
     try:
-        s3_file_object = open(s3_file, 'r')
-        print('SUCCESS : File has been read')
-    except FileNotFoundError:
-        print('FAIL : Specified file not found.')
-        raise
+        rejects = []
+        row_count = db_helper.insert_batches_pipelined(conn, sql, get_optimized_query_data(download_path, rejects),
+                                                       batch_bytes, on_batch, commit=False)
+    finally:
+        shutil.rmtree(tmpdir)
 
-    data_set = []
+    check_rejects(source_bucket, key, rejects, row_count)
+    return row_count
 
-    for line in s3_file_object.readlines():
-        splitted_line = line.split()
 
-        # Removes accession_number and type from line
-        number_and_type = splitted_line[0]
-        accession_number = number_and_type[:-1]
-        specimen_type = number_and_type[-1]
-        new_line_list = splitted_line[1:]
+def check_file_type(key):
+    """ Fails upload that is no LOG, name of file inside zip is checked once it is opened """
+    file_type = compression.get_content_name(key).split('.')[-1]
+    if file_type.lower() not in ('log', 'zip'):
+        print('FAIL: File type is not supported!')
+        raise TypeError('Not supported file!')
 
-        # Building string back to split by 01
-        new_line = ' '.join(new_line_list)
 
-        # Splitting string back
-        splitted_parts = new_line.split('01', 1)
-        name_part = splitted_parts[0]
-        concentration_part = splitted_parts[1]
+def check_rejects(source_bucket, key, rejects, row_count):
+    """ Sends malformed records of object to error sink, fails object without any valid record
+        Args: source_bucket, key, rejects(list of (line number, line)), row_count(valid records)
+    """
+    if not rejects:
+        return
 
-        # Building patient name
-        patient_name = name_part.replace(',', '').rstrip()
+    metrics.count('rejected_rows', len(rejects))
+    write_rejects(source_bucket, key, rejects)
 
-        data = [accession_number, specimen_type, patient_name]
+    if not row_count:
+        raise ValueError('FAIL: No valid Olympus record in file! {}'.format(key))
 
-        # Concentration values and their indexes from machine
-        concentration_values = concentration_part.split()
 
-        # Picking up concentration values
-        for i in range(0, len(concentration_values), 2):
-            data.append(concentration_values[i])
+def write_rejects(source_bucket, key, rejects):
+    """ Error sink of malformed records, logs them and keeps them in REJECTS_BUCKET when it is set
+        Args: source_bucket, key, rejects(list of (line number, line))
+    """
+    print('FAIL: {} malformed Olympus records skipped in {}, first on line {}: {!r}'.format(
+        len(rejects), key, rejects[0][0], rejects[0][1]))
+
+    if REJECTS_BUCKET:
+        body = ''.join('{}\t{}\n'.format(line_number, line) for line_number, line in rejects)
+        cold_start.get_client('s3').put_object(Bucket=REJECTS_BUCKET, Key='{}/{}.rejects.txt'.format(source_bucket, key),
+                                               Body=body.encode('utf-8'))
 
-        data_set.append(tuple(data))
 
-        if len(data_set) == 10000:
-            yield data_set
-            data_set = []
+def get_optimized_query_data(s3_file, rejects=None):
+    """
+        s3_file : File temp location to s3 file, plain or .gz/.zst/.zip, decompressed while it is read
+        rejects : List receiving (line number, line) of malformed records, first one raises ValueError when None
+        Yield : Row tuple per log line, test values as float (None where instrument sent no number), then values as sent
+                or None where report writes them out from numbers
+    """
+
+    try:
+        s3_file_object = open(s3_file, 'rb')
+    except FileNotFoundError:
+        print('FAIL : Specified file not found.')
+        raise
+
+    with s3_file_object, compression.open_decompressed(s3_file_object, s3_file) as (content_name, stream):
+        if content_name.split('.')[-1].lower() != 'log':
+            print('FAIL: File type is not supported!')
+            raise TypeError('Not supported file!')
 
-    s3_file_object.close()
-    yield data_set
+        for line_number, line in enumerate(io.TextIOWrapper(stream, encoding='utf-8'), 1):
+            # number_and_type and name, '01', value and flag of every test
+            fields = line.rsplit(None, OLYMPUS_TEST_COUNT * 2 + 1)
+            if not fields:
+                continue
+
+            number_and_type, _, patient_name = fields[0].lstrip().partition(' ')
+
+            if len(fields) != OLYMPUS_TEST_COUNT * 2 + 2 or fields[1] != '01' or not number_and_type[:-1].isdigit() \
+                    or number_and_type[-1].isdigit():
+                if rejects is None:
+                    raise ValueError('FAIL: Malformed Olympus record on line {}: {!r}'.format(line_number, line))
+                rejects.append((line_number, line.rstrip('\r\n')))
+                continue
+
+            # Values are converted once here for typed columns. float() takes nan and inf too, their sum is not finite.
+            # Output that is no number (e.g. >1000) gets NULL. raw_values keeps every value as sent, only for record
+            # whose values report could not write out from numbers
+            raw_values = fields[2::2]
+            try:
+                values = tuple(map(float, raw_values))
+                if not math.isfinite(sum(values)):
+                    raise ValueError
+                formatted = db_helper.is_repr_numbers(raw_values)
+            except ValueError:
+                values = tuple(db_helper.parse_number(raw_value)[0] for raw_value in raw_values)
+                formatted = False
+
+            # Name keeps single spaces between words and no commas, as before
+            yield (number_and_type[:-1], number_and_type[-1], ' '.join(patient_name.split()).replace(',', '')) + \
+                values + (None if formatted else ' '.join(raw_values), )
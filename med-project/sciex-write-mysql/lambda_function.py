@@ -1,11 +1,15 @@
+import io
 import sys
 import os
+import shutil
 import tempfile
 
-import boto3
-import pymysql
-
+import archive
+import cold_start
+import compression
 import database_helper as db_helper
+import metrics
+import s3_helper
 
 
 DB_HOST = os.environ['DB_HOST']
@@ -13,81 +17,307 @@ DB_USERNAME = os.environ['DB_USERNAME']
 DB_PASSWORD = os.environ['DB_PASSWORD']
 DB_NAME = os.environ['DB_NAME']
 
-s3 = boto3.client('s3')
+# Months of sciex and olympus results kept, older monthly partitions are dropped. 0 keeps everything
+RETENTION_MONTHS = int(os.environ.get('RETENTION_MONTHS', 0))
+
+# Streaming mode reads object body from S3 directly, without TEMPDIR
+STREAMING = os.environ.get('STREAMING', 'false').lower() == 'true'
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Bulk load mode normalizes file once and loads it with LOAD DATA LOCAL INFILE
+BULK_LOAD = os.environ.get('BULK_LOAD', 'false').lower() == 'true'
+SCIEX_COLUMNS = ('sample_name', 'component_name', 'actual_concentration', 'actual_concentration_raw',
+                 'calculated_concentration', 'calculated_concentration_raw')
+
+# Column types of Parquet archive, written when ARCHIVE_TARGET is set
+SCIEX_ARCHIVE_COLUMNS = tuple(zip(SCIEX_COLUMNS, ('string', 'string', 'double', 'string', 'double', 'string')))
+
+# Pipelined mode parses rows on producer thread while earlier batches are written
+PIPELINE = os.environ.get('PIPELINE', 'false').lower() == 'true'
 
+# Turned off for the container once server refuses LOCAL INFILE
+local_infile_allowed = True
 
+
+@cold_start.report_init
+@metrics.instrumented('sciex-write-mysql')
 def lambda_handler(event, context):
 
-    # Connection setup
+    # Connection setup, reused while the container stays warm
     try:
-        conn = pymysql.connect(DB_HOST, user=DB_USERNAME, 
-                            passwd=DB_PASSWORD, db=DB_NAME, 
-                            connect_timeout=5, charset='utf8mb4',
-                            cursorclass=pymysql.cursors.DictCursor)
+        with metrics.span('connect'):
+            conn = db_helper.get_connection(DB_HOST, DB_USERNAME, DB_PASSWORD, DB_NAME, local_infile=BULK_LOAD)
     
-    except pymysql.MySQLError as e:
+    except db_helper.MySQLError as e:
         print("ERROR: Unexpected error: Could not connect to MySQL instance.")
         print(e)
         sys.exit()
-    
-    print("SUCCESS: Connection to RDS MySQL instance succeeded")
 
-    # Creating table in case, No table
-    if not db_helper.table_exists(conn, DB_NAME, 'sciex'):
-        print('INFO: No table, creating.')
-        db_helper.create_sciex_table(conn)
-        print('SUCCESS: Table created.')
+    # Admin invocation {"migrate": true} applies every pending migration, table-copy ones included
+    if event.get('migrate'):
+        with metrics.span('migrate'):
+            return {'schema_version': db_helper.migrate(conn, DB_NAME, offline=True)}
+
+    # Getting event info, unsupported uploads fail before S3 client is created or anything is claimed
+    event_objects = s3_helper.get_event_objects(event)
+    for source_bucket, key, etag in event_objects:
+        check_file_type(key)
+
+    # Creating tables and indexes in case, schema is behind, then monthly partitions ahead and expired ones dropped
+    with metrics.span('migrate'):
+        db_helper.migrate(conn, DB_NAME, table_names=('result_machine_sciex', ))
+        db_helper.maintain_partitions(conn, DB_NAME, RETENTION_MONTHS)
+
+    # Objects loaded before are skipped
+    with metrics.span('claim'):
+        objects = db_helper.claim_objects(conn, event_objects, db_helper.get_lease_seconds(context))
+    metrics.count('objects', len(objects))
+    sql = """INSERT INTO result_machine_sciex (sample_name, component_name, actual_concentration, actual_concentration_raw,
+             calculated_concentration, calculated_concentration_raw) VALUES (%s, %s, %s, %s, %s, %s)"""
+
+    if BULK_LOAD:
+        results = s3_helper.map_objects(prepare_bulk_load, objects)
+    elif STREAMING:
+        # Objects are read one after another, each batch is written while rest of body is in flight
+        results = ((source_bucket, key, etag, get_streaming_query_data(source_bucket, key))
+                   for source_bucket, key, etag in objects)
+    elif PIPELINE:
+        # Downloads overlap on thread pool, each file is parsed while its batches are written
+        results = s3_helper.map_objects(download_s3_object, objects)
+    else:
+        # Downloads and parses overlap on thread pool
+        results = s3_helper.map_objects(load_s3_object, objects)
+
+    insert_batches = db_helper.insert_batches_pipelined if PIPELINE else db_helper.insert_batches
+
+    loaded = []
+    object_archive = None
+
+    try:
+        # Batches are sized by bytes against server max_allowed_packet, claims are released when it cannot be read
+        batch_bytes = db_helper.get_batch_bytes(conn)
+
+        for source_bucket, key, etag, data in results:
+            # Written batches are archived too when ARCHIVE_TARGET is set, archive is published once object is committed
+            object_archive = archive.open_archive('sciex', SCIEX_ARCHIVE_COLUMNS, key, etag)
+            on_batch = object_archive.write_batch if object_archive else None
+
+            # Streamed rows are parsed while they are written, so write includes parse time in streaming and pipelined mode.
+            # Rows of object are committed in one transaction together with manifest row
+            with metrics.span('write'):
+                if BULK_LOAD:
+                    row_count = bulk_load(conn, sql, *data, on_batch=on_batch)
+                elif PIPELINE and not STREAMING:
+                    row_count = pipelined_load(conn, sql, batch_bytes, *data, on_batch=on_batch)
+                else:
+                    row_count = insert_batches(conn, sql, data, batch_bytes, on_batch, commit=False)
+
+                with metrics.span('commit'):
+                    db_helper.finish_ingest(conn, source_bucket, key, etag, row_count)
+
+            if object_archive:
+                object_archive.close()
 
-    # Getting event info
-    source_bucket = event['Records'][0]['s3']['bucket']['name']
-    key = event['Records'][0]['s3']['object']['key']
-    print('SUCCESS : Object was uploaded: {}'.format(key))
+            metrics.count('rows', row_count)
+            loaded.append((source_bucket, key, etag))
 
+    except Exception:
+        if object_archive:
+            object_archive.discard()
+        db_helper.fail_ingest(conn, [obj for obj in objects if obj not in loaded])
+        raise
+
+
+def load_s3_object(source_bucket, key):
+    """ Downloads and parses one uploaded object
+        Args: source_bucket, key
+        Returns: list of row tuples
+    """
     # Temporary location for storing s3 object
     with tempfile.TemporaryDirectory() as tmpdir:
         file_name = key.split('/')[-1]
-        file_type = file_name.split('.')[-1]
 
         download_path = os.path.join(tmpdir, file_name)
-        print('SUCCESS: TEMPDIR has been created')
 
-        s3.download_file(source_bucket, key, download_path)
-        print('SUCCESS: S3 Object has been downloaded')
+        with metrics.span('download'):
+            cold_start.get_client('s3').download_file(source_bucket, key, download_path)
+        metrics.count('bytes', os.path.getsize(download_path))
+
+        with metrics.span('parse'):
+            return list(get_optimized_query_data(download_path))
 
-        # Getting data by set 80000 rows or less
-        query_data_generator = get_optimized_query_data(download_path, file_type)
-        sql = """INSERT INTO sciex (sample_name, component_name, actual_concentration, calculated_concentration) 
-                 VALUES (%s, %s, %s, %s)"""
 
-        # MySQL cursor
-        with conn.cursor() as cursor:
+def download_s3_object(source_bucket, key):
+    """ Downloads one uploaded object for pipelined load
+        Args: source_bucket, key
+        Returns: (tmpdir, download_path), caller removes tmpdir
+    """
+    tmpdir = tempfile.mkdtemp()
+    download_path = os.path.join(tmpdir, key.split('/')[-1])
 
-            for data in query_data_generator:
-                cursor.executemany(sql, data)
-                conn.commit()
-                print('SUCCESS: Committing...')
+    try:
+        with metrics.span('download'):
+            cold_start.get_client('s3').download_file(source_bucket, key, download_path)
+        metrics.count('bytes', os.path.getsize(download_path))
 
-    print('SUCCESS: DONE')
+    except Exception:
+        shutil.rmtree(tmpdir)
+        raise
 
-    conn.close()
+    return tmpdir, download_path
 
 
-def get_optimized_query_data(s3_file, s3_file_type):
+def pipelined_load(conn, sql, batch_bytes, tmpdir, download_path, on_batch=None):
+    """ Parses downloaded file on producer thread while its batches are written
+        Args: conn(DB connection), sql(executemany INSERT), batch_bytes, tmpdir(removed afterwards), download_path,
+              on_batch(called with every written batch)
+        Returns: number of inserted rows, caller commits
     """
-        s3_file : File temp locationto s3 file
-        s3_file_type : file type to recognize (ONLY TXT or CSV)
+    try:
+        return db_helper.insert_batches_pipelined(
+            conn, sql, get_optimized_query_data(download_path), batch_bytes, on_batch, commit=False)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def prepare_bulk_load(source_bucket, key):
+    """ Downloads one uploaded object and writes its normalized copy for LOAD DATA
+        Args: source_bucket, key
+        Returns: (tmpdir, download_path, normalized_path), caller removes tmpdir
+    """
+    tmpdir = tempfile.mkdtemp()
+    file_name = key.split('/')[-1]
+
+    download_path = os.path.join(tmpdir, file_name)
+    normalized_path = os.path.join(tmpdir, 'normalized.tsv')
+
+    try:
+        with metrics.span('download'):
+            cold_start.get_client('s3').download_file(source_bucket, key, download_path)
+        metrics.count('bytes', os.path.getsize(download_path))
+
+        # Same rows as executemany would insert, short rows padded with Blank
+        with metrics.span('parse'), open(normalized_path, 'w', encoding='utf-8', newline='\n') as normalized_file:
+            normalized_file.writelines('\t'.join(escape_load_data_field(field) for field in data) + '\n'
+                                       for data in get_optimized_query_data(download_path))
+
+    except Exception:
+        shutil.rmtree(tmpdir)
+        raise
 
-        Yield : Slice file lines by 50k or less
+    return tmpdir, download_path, normalized_path
+
+
+def bulk_load(conn, sql, tmpdir, download_path, normalized_path, on_batch=None):
+    """ Loads normalized file, falls back to executemany when server disallows LOCAL INFILE
+        Args: conn(DB connection), sql(executemany INSERT), tmpdir(removed afterwards), download_path, normalized_path,
+              on_batch(called with batches of loaded rows)
+        Returns: number of loaded rows, caller commits
+    """
+    global local_infile_allowed
+
+    try:
+        if local_infile_allowed:
+            try:
+                with metrics.span('insert'):
+                    rows = db_helper.load_data_local_infile(conn, 'result_machine_sciex', SCIEX_COLUMNS, normalized_path)
+
+                # LOAD DATA has no batches, file is parsed once more for them
+                if on_batch is not None:
+                    for batch in db_helper.iter_sized_batches(get_optimized_query_data(download_path), db_helper.MAX_BATCH_BYTES):
+                        on_batch(batch)
+                return rows
+
+            except db_helper.MySQLError as e:
+                if e.args[0] not in db_helper.LOCAL_INFILE_DISABLED_ERRORS:
+                    raise
+
+                conn.rollback()
+                local_infile_allowed = False
+                print('INFO: LOCAL INFILE is not allowed, falling back to executemany. {}'.format(e))
+
+        return db_helper.insert_batches(conn, sql, get_optimized_query_data(download_path), on_batch=on_batch, commit=False)
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def escape_load_data_field(field):
+    """ Escapes field for LOAD DATA default FIELDS ESCAPED BY '\\', None as NULL """
+    if field is None:
+        return '\\N'
+    if isinstance(field, float):
+        return repr(field)
+    return field.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def get_file_type(key):
+    """ Returns extension of uploaded object, or of file inside .gz/.zst/.zip upload """
+    return compression.get_content_name(key).split('.')[-1]
+
+
+def check_file_type(key):
+    """ Fails upload that is no TXT or CSV, name of file inside zip is checked once it is opened """
+    file_type = get_file_type(key)
+    if file_type not in ('txt', 'csv') and file_type.lower() != 'zip':
+        print('FAIL : Not supported file type')
+        raise TypeError('Not supported file!')
+
+
+def get_optimized_query_data(s3_file, s3_file_type=None):
+    """
+        s3_file : File temp locationto s3 file, plain or .gz/.zst/.zip, decompressed while it is read
+        s3_file_type : file type to recognize (ONLY TXT or CSV), taken from file name when None
+
+        Yield : Row tuple per file line
     
     """
 
     try:
-        s3_file_object = open(s3_file, 'r')
-        print('SUCCESS : File has been read')
+        s3_file_object = open(s3_file, 'rb')
     except FileNotFoundError:
         print('FAIL : Specified file not found.')
         raise
 
+    with s3_file_object, compression.open_decompressed(s3_file_object, s3_file) as (content_name, stream):
+        lines = io.TextIOWrapper(stream, encoding='utf-8')
+        yield from get_query_data_from_lines(lines, s3_file_type or get_file_type(content_name))
+
+
+def get_streaming_query_data(source_bucket, key):
+    """
+        source_bucket, key : S3 object to read, without downloading it first, plain or .gz/.zst/.zip
+        
+        Yield : Row tuple per body line, while body is still being read
+    """
+
+    with metrics.span('download'):
+        response = cold_start.get_client('s3').get_object(Bucket=source_bucket, Key=key)
+    metrics.count('bytes', response['ContentLength'])
+
+    body = response['Body']
+
+    try:
+        with compression.open_decompressed(body, key) as (content_name, stream):
+            if stream is body:
+                lines = (line.decode('utf-8') for line in body.iter_lines(chunk_size=STREAM_CHUNK_SIZE))
+            else:
+                lines = io.TextIOWrapper(stream, encoding='utf-8')
+
+            yield from get_query_data_from_lines(lines, get_file_type(content_name))
+    finally:
+        body.close()
+
+
+def get_query_data_from_lines(lines, s3_file_type):
+    """
+        lines : Iterable of TXT/CSV file lines, header line first
+        s3_file_type : file type to recognize (ONLY TXT or CSV)
+
+        Yield : Row tuple per line, concentrations as (number, raw text) pairs, short rows padded with Blank.
+                Raw text is None where report writes concentration out from number
+    """
+
     if s3_file_type == 'txt':
         split_sign = '\t'
     elif s3_file_type == 'csv':
@@ -96,15 +326,15 @@ def get_optimized_query_data(s3_file, s3_file_type):
         print('FAIL : Not supported file type')
         raise TypeError
 
-    data_set = []
-    header = s3_file_object.readline().split(split_sign)
+    lines = iter(lines)
+    header = next(lines, '').split(split_sign)
 
     # Check if expected format file is: TXT (tab spaced), CSV (comma spaced)
     if len(header) < 4:
         print('FAIL: TXT/CSV file must be formated -> (TXT tab separeted), (CSV comma separated)' )
         raise TypeError
 
-    for line in s3_file_object.readlines():
+    for line in lines:
         formated_line = line.rstrip().split(split_sign)
 
         # In case empthy field
@@ -112,11 +342,7 @@ def get_optimized_query_data(s3_file, s3_file_type):
             while len(formated_line) < 4:
                 formated_line.append('Blank')
 
-        data_set.append(tuple(formated_line))
-
-        if len(data_set) == 80000:
-            yield data_set
-            data_set = []
-
-    s3_file_object.close()
-    yield data_set
+        # Numbers go to typed columns once here, N/A, Blank and numbers written otherwise (12.50) to raw text columns
+        sample_name, component_name, actual_concentration, calculated_concentration = formated_line
+        yield (sample_name, component_name) + db_helper.parse_number(actual_concentration) + \
+            db_helper.parse_number(calculated_concentration)